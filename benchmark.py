@@ -0,0 +1,560 @@
+"""
+Local benchmarks of the forwarder. server.py and every peer run as processes on this machine, nothing has to be
+deployed to EC2 or Lambda.
+
+e.g. compare the server relay with the direct peer to peer data plane
+python benchmark.py direct --peers 8 --messages 500 --size 4096
+or measure the relayed message rate of 1 to 4 server shards
+python benchmark.py shards --max-shards 4 --peers 16
+or compare the PageRank kernels of pagerank.py on a synthetic power-law graph, or on files written by preprocess.py
+python benchmark.py pagerank --vertices 200000 --parts 8
+python benchmark.py pagerank --dataset soc-pokec_dataset --partition soc-pokec_dataset_partition_20
+or compare time to accuracy of lock step PageRank against bounded staleness, with a random delay of every turn
+python benchmark.py staleness --parts 4 --staleness 0 1 2 --jitter 0.02
+or compare edge cut and communication volume of the built-in partitioners of partitioner.py
+python benchmark.py partition --vertices 200000 --parts 8
+or run the suite of message rate and latency, registration time and PageRank of client.py through local.py, for
+several modes of the forwarder, and append the results to a JSON lines file to track them between versions
+python benchmark.py suite --modes binary-process direct-thread --peers 2 4 8 --output benchmark.jsonl
+"""
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import random
+import socket
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+import client
+import graphfile
+import invoker
+import local
+import pagerank
+import partitioner
+import softwareforwarder
+
+softwareforwarder.logger.setLevel(logging.WARNING)
+pagerank.logger.setLevel(logging.WARNING)
+client.logger.setLevel(logging.WARNING)
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server(port: int, peers: int, host: str = '127.0.0.1', shards: Sequence[str] = (),
+                 shard_index: int = 0) -> subprocess.Popen:
+    command = [sys.executable, os.path.join(HERE, 'server.py'), '--host', host, '--port', str(port),
+               '--peers', str(peers)]
+    if shards:
+        command += ['--shards', ','.join(shards), '--shard-index', str(shard_index)]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return process
+        except OSError:
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise RuntimeError(f'server.py did not start listening on {host}:{port}')
+            time.sleep(0.1)
+
+
+def stop_server(process: subprocess.Popen):
+    # pending long polls of terminated receivers keep uvicorn from shutting down gracefully
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def exchange_worker(url: str, options: Dict, messages: int, size: int, results: multiprocessing.Queue):
+    """
+    every peer sends messages payloads of size bytes to every other peer, then receives all payloads sent to it
+    """
+
+    @softwareforwarder.SoftwareForwarder(url=url, **options)
+    def main(event, context):
+        sen, rec, uid, peers = event['sen'], event['rec'], event['uid'], event['peers']
+        others = [peer for peer in peers if peer != uid]
+        payload = b'x' * size
+        start_time = time.perf_counter()
+        for _ in range(messages):
+            for peer in others:
+                sen(peer, payload)
+        for _ in range(messages * len(others)):
+            rec()
+        return time.perf_counter() - start_time
+
+    results.put(main({}, None))
+
+
+def run_exchange(url: str, peers: int, options: Dict, messages: int, size: int) -> Dict:
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=exchange_worker, args=(url, options, messages, size, results))
+               for _ in range(peers)]
+    for worker in workers:
+        worker.start()
+    durations: List[float] = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    seconds = max(durations)
+    total = peers * (peers - 1) * messages
+    return {'options': options, 'peers': peers, 'size': size, 'messages': total, 'seconds': seconds,
+            'msg/s': total / seconds, 'MB/s': total * size / seconds / 2 ** 20}
+
+
+def bench_direct(args):
+    server = start_server(args.port, args.peers)
+    url = f'http://127.0.0.1:{args.port}'
+    try:
+        relay = run_exchange(url, args.peers, {'batch_size': args.batch_size}, args.messages, args.size)
+        direct = run_exchange(url, args.peers, {'batch_size': args.batch_size, 'direct': True}, args.messages,
+                              args.size)
+    finally:
+        stop_server(server)
+    for name, result in (('relay', relay), ('direct', direct)):
+        print(f'{name:<7} {result["messages"]} messages in {result["seconds"]:.3f}s, '
+              f'{result["msg/s"]:.0f} msg/s, {result["MB/s"]:.1f} MB/s')
+    print(f'direct / relay throughput = {direct["msg/s"] / relay["msg/s"]:.2f}x')
+
+
+def bench_shards(args):
+    options = {'batch_size': args.batch_size, 'engine': 'thread'}
+    results = []
+    for n in range(1, args.max_shards + 1):
+        ports = range(args.port, args.port + n)
+        shards = [f'http://127.0.0.1:{port}' for port in ports]
+        servers = [start_server(port, args.peers, shards=shards if n > 1 else (), shard_index=i)
+                   for i, port in enumerate(ports)]
+        try:
+            results.append(run_exchange(shards[0], args.peers, options, args.messages, args.size))
+        finally:
+            for server in servers:
+                stop_server(server)
+    for n, result in enumerate(results, 1):
+        print(f'{n} shards: {result["msg/s"]:.0f} msg/s, {result["msg/s"] / results[0]["msg/s"]:.2f}x of 1 shard')
+
+
+def synthetic_graph(vertices: int, degree: int, parts: int, seed: int = 0) -> Tuple[str, str, str]:
+    """
+    directed graph with power-law in-degrees, in the text format of preprocess.py. Most edges stay within blocks of
+    neighbouring vertices, the partition cuts the vertices into parts blocks, like a partitioner would.
+    :return: dataset, r_dataset, partition
+    """
+    rng = np.random.default_rng(seed)
+    sources = rng.integers(0, vertices, vertices * degree)
+    # popularity of the targets falls off as a power law of their rank
+    ranks = (vertices * rng.random(len(sources)) ** 3).astype(np.int64)
+    local = rng.random(len(sources)) < 0.8
+    block = max(vertices // parts, 1)
+    targets = np.where(local, sources // block * block + ranks % block, rng.permutation(vertices)[ranks])
+    targets = np.minimum(targets, vertices - 1)
+    edges = np.unique(np.stack((sources, targets), axis=1), axis=0)
+    edges = edges[edges[:, 0] != edges[:, 1]]
+
+    def lines(keys: np.ndarray, values: np.ndarray) -> str:
+        order = np.argsort(keys, kind='stable')
+        keys, values = keys[order], values[order] + 1
+        bounds = np.searchsorted(keys, np.arange(vertices + 1))
+        return ''.join(' '.join(map(str, values[bounds[v]:bounds[v + 1]].tolist())) + '\n' for v in range(vertices))
+
+    partition = '\n'.join(str(min(v // block, parts - 1) + 1) for v in range(vertices))
+    return lines(edges[:, 0], edges[:, 1]), lines(edges[:, 1], edges[:, 0]), partition
+
+
+def simulate_pagerank(kernel: str, graph: Union[pagerank.Graph, Dict[int, bytes]], parts: int, turns: int,
+                      **options) -> Dict:
+    """
+    every sub-graph in this process, messages are handed over in memory
+    :param graph: the whole graph, or the packed shard of every sub-graph
+    :param options: precision, tolerance, damping and dangling_policy of the csr kernel
+    """
+    start_time = time.perf_counter()
+    subgraphs = {uid: pagerank.load_subgraph(kernel, graph if isinstance(graph, pagerank.Graph) else
+                                             graphfile.read(graph[uid]), uid, **options)
+                 for uid in range(1, parts + 1)}
+    setup = time.perf_counter() - start_time
+    # seconds of every phase of the setup, summed over workers
+    phases: Dict[str, float] = {}
+    for subgraph in subgraphs.values():
+        for phase, spent in subgraph.timings.items():
+            phases[phase] = phases.get(phase, 0.0) + spent
+    nodes_num = sum(len(subgraph.in_vs) for subgraph in subgraphs.values())
+    # bytes of the pickled messages of every turn, as sen() would send them
+    sent = []
+    # seconds from the start of a turn until a worker has sent its messages, summed over workers and turns
+    critical = 0.0
+    start_time = time.perf_counter()
+    for turn in range(1, turns + 1):
+        inboxes: Dict[int, List] = {uid: [] for uid in subgraphs}
+        sent.append(0)
+        share = sum(subgraph.dangling_mass() for subgraph in subgraphs.values()) / nodes_num
+        for subgraph in subgraphs.values():
+            turn_start = time.perf_counter()
+            subgraph.compute(share)
+            outgoing = list(subgraph.outgoing())
+            critical += time.perf_counter() - turn_start
+            for sg, payload in outgoing:
+                inboxes[sg].append(payload)
+                sent[-1] += len(pickle.dumps((turn, subgraph.uid, payload), protocol=pickle.HIGHEST_PROTOCOL))
+            subgraph.interior()
+        for uid, subgraph in subgraphs.items():
+            for payload in inboxes[uid]:
+                subgraph.apply(payload)
+            subgraph.advance()
+    seconds = time.perf_counter() - start_time
+    ranks = {}
+    for subgraph in subgraphs.values():
+        ranks.update(subgraph.result())
+    return {'kernel': kernel, 'parts': parts, 'turns': turns, 'setup': setup, 'setup phases': phases,
+            'seconds per turn': seconds / turns, 'seconds to send': critical / turns / parts,
+            'first turn bytes': sent[0], 'bytes per turn': sum(sent[1:]) / max(turns - 1, 1), 'ranks': ranks}
+
+
+def bench_pagerank(args):
+    if args.dataset:
+        files = []
+        for path in (args.dataset, args.partition, args.r_dataset or f'r_{args.dataset}'):
+            if os.path.exists(path):
+                with open(path, 'rb') as file:
+                    files.append(file.read())
+            else:  # no reverse dataset next to a binary container
+                files.append(None)
+    else:
+        files = [text.encode() for text in synthetic_graph(args.vertices, args.degree, args.parts)]
+        files[1:] = files[2], files[1]
+    start_time = time.perf_counter()
+    graph = pagerank.Graph.load(*files)
+    load = time.perf_counter() - start_time
+    parts = int(graph.partition.max())
+
+    # the same graph in the containers of graphfile.py, loaded without parsing
+    containers = graphfile.pack(graph.arrays()), graphfile.pack({'partition': graph.partition})
+    start_time = time.perf_counter()
+    pagerank.Graph.load(*containers)
+    binary_load = time.perf_counter() - start_time
+    print(f'load {"binary" if graphfile.is_container(files[0]) else "text"} {load:.3f}s, '
+          f'binary {binary_load * 1000:.3f} ms ({sum(map(len, containers)) / 2 ** 20:.1f} MB)')
+
+    # the shard of every sub-graph written by preprocess.py, a worker loads only its own
+    shards = {uid: graphfile.pack(pagerank.CsrSubgraph.from_graph(graph, uid).shard()) for uid in range(1, parts + 1)}
+    print(f'shards {sum(map(len, shards.values())) / parts / 2 ** 20:.2f} MB per worker on average')
+
+    results = [simulate_pagerank(kernel, graph, parts, args.turns) for kernel in ('dict', 'csr')]
+    results.append(simulate_pagerank('csr', shards, parts, args.turns))
+    for name, result in zip(('dict', 'csr', 'shard'), results):
+        print(f'{name:<5} setup {result["setup"] / parts * 1000:.1f} ms per worker, '
+              f'{result["seconds per turn"] * 1000:.1f} ms per turn, messages sent after '
+              f'{result["seconds to send"] * 1000:.2f} ms')
+        print('      setup ' + ', '.join(f'{phase} {seconds / parts * 1000:.1f} ms'
+                                         for phase, seconds in result['setup phases'].items()))
+    dict_ranks = results[0]['ranks']
+    error = max(abs(dict_ranks[v] - result['ranks'][v]) for result in results[1:] for v in dict_ranks)
+    print(f'csr / dict speed up per turn = {results[0]["seconds per turn"] / results[1]["seconds per turn"]:.1f}x, '
+          f'max difference of ranks = {error:.3g}')
+
+    # bytes on the wire after the first turn, which also carries the vertices of the csr kernel
+    codecs = [('dict', results[0]), ('float64', results[1])]
+    codecs += [(f'{precision}, tolerance {tolerance:g}',
+                simulate_pagerank('csr', graph, parts, args.turns, precision=precision, tolerance=tolerance))
+               for precision, tolerance in (('float32', 0.0), ('float32', args.tolerance))]
+    for name, result in codecs:
+        error = max(abs(dict_ranks[v] - result['ranks'][v]) / dict_ranks[v] for v in dict_ranks if dict_ranks[v])
+        print(f'{name:<24} {result["bytes per turn"] / 2 ** 10:.1f} KiB per turn '
+              f'({results[0]["bytes per turn"] / result["bytes per turn"]:.1f}x less than dict), first turn '
+              f'{result["first turn bytes"] / 2 ** 10:.1f} KiB, max relative difference of ranks {error:.2g}')
+
+
+def staleness_worker(url: str, job: str, direct: bool, shards: Dict[int, bytes], options: Dict, run_options: Dict,
+                     turns: int, jitter: float, results: multiprocessing.Queue):
+    """
+    one worker of the PageRank of client.py, every turn is delayed by an exponentially distributed time of mean
+    jitter seconds, like the varying speed of Lambda instances
+    """
+
+    @softwareforwarder.SoftwareForwarder(url=url, engine='thread', job=job, size=len(shards), direct=direct)
+    def main(event, context):
+        uid = event['uid']
+        subgraph = pagerank.load_subgraph('csr', graphfile.read(shards[uid]), uid, **options)
+        rng = random.Random(uid)
+        compute = subgraph.compute
+
+        def delayed_compute(share: float = 0.0):
+            time.sleep(rng.expovariate(1 / jitter) if jitter else 0)
+            compute(share)
+
+        subgraph.compute = delayed_compute
+        start_time = time.perf_counter()
+        done = pagerank.run(subgraph, event['sen'], event['rec'], range(1, turns + 1), allreduce=event['allreduce'],
+                            **run_options)
+        return time.perf_counter() - start_time, done, subgraph.result()
+
+    results.put(main({}, None))
+
+
+def bench_staleness(args):
+    files = [text.encode() for text in synthetic_graph(args.vertices, args.degree, args.parts)]
+    graph = pagerank.Graph.load(files[0], files[2], files[1])
+    options = {'damping': args.damping, 'dangling_policy': args.dangling}
+    shards = {uid: graphfile.pack(pagerank.CsrSubgraph.from_graph(graph, uid).shard())
+              for uid in range(1, args.parts + 1)}
+    # converged ranks, computed in lock step in this process
+    reference = simulate_pagerank('csr', graph, args.parts, 500, **options)['ranks']
+    server = start_server(args.port, args.parts)
+    url = f'http://127.0.0.1:{args.port}'
+    try:
+        for staleness in args.staleness:
+            results = multiprocessing.Queue()
+            run_options = {'staleness': staleness, 'threshold': args.threshold}
+            workers = [multiprocessing.Process(target=staleness_worker,
+                                               args=(url, f'staleness-{staleness}', not args.relay, shards, options,
+                                                     run_options, args.turns, args.jitter, results))
+                       for _ in range(args.parts)]
+            for worker in workers:
+                worker.start()
+            outcomes = [results.get() for _ in workers]
+            for worker in workers:
+                worker.join()
+            ranks = {}
+            for _, _, result in outcomes:
+                ranks.update(result)
+            error = sum(abs(ranks[v] - reference[v]) for v in reference) / len(reference)
+            print(f'staleness {staleness}: {max(seconds for seconds, _, _ in outcomes):.2f}s, '
+                  f'{max(done for _, done, _ in outcomes)} turns, mean error of ranks {error:.2g}')
+    finally:
+        stop_server(server)
+
+
+def bench_partition(args):
+    files = [text.encode() for text in synthetic_graph(args.vertices, args.degree, args.parts)]
+    graph = pagerank.Graph.load(files[0], files[2], files[1])
+    arrays = graph.arrays()
+    # the blocks synthetic_graph made most edges stay in, the partition a partitioner should find
+    print(f'{"planted":<7} {partitioner.summary(partitioner.quality(arrays, graph.partition))}')
+    for method in ('hash', 'ldg', 'fennel'):
+        start_time = time.perf_counter()
+        partition = partitioner.partition_graph(method, arrays, args.parts)
+        seconds = time.perf_counter() - start_time
+        print(f'{method:<7} {seconds:.2f}s, {partitioner.summary(partitioner.quality(arrays, partition))}')
+
+
+# modes of the forwarder compared by the suite, keyword arguments of SoftwareForwarder
+MODES = {
+    'binary-process': {},
+    'binary-thread': {'engine': 'thread'},
+    'batch-thread': {'engine': 'thread', 'batch_size': 64, 'linger': 0.001},
+    'websocket-thread': {'engine': 'thread', 'transport': 'websocket'},
+    'direct-thread': {'engine': 'thread', 'direct': True},
+}
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    return float(np.percentile(values, q)) if len(values) else float('nan')
+
+
+def suite_worker(url: str, options: Dict, job: str, peers: int, messages: int, size: int,
+                 results: multiprocessing.Queue):
+    """
+    latency: messages rounds in a ring, every peer sends to the next one and waits for the message of the previous one.
+    Messages carry the time they were sent, the monotonic clock is the same for all processes of a Linux machine.
+    rate: every peer sends messages payloads of size bytes to every other peer and receives all payloads sent to it.
+    """
+    start_time = time.monotonic()
+
+    @softwareforwarder.SoftwareForwarder(url=url, job=job, size=peers, **options)
+    def main(event, context):
+        registered = time.monotonic()
+        sen, rec, uid, barrier = event['sen'], event['rec'], event['uid'], event['barrier']
+        payload = b'x' * size
+        latencies = []
+        for _ in range(messages):
+            sen(uid % peers + 1, (time.monotonic(), payload))
+            sent, _ = rec()
+            latencies.append(time.monotonic() - sent)
+        barrier('rate')
+        rate_start = time.perf_counter()
+        for _ in range(messages):
+            for peer in event['peers']:
+                if peer != uid:
+                    sen(peer, payload)
+        for _ in range(messages * (peers - 1)):
+            rec()
+        return {'registration': registered - start_time, 'registered': registered, 'latencies': latencies,
+                'seconds': time.perf_counter() - rate_start}
+
+    results.put(main({}, None))
+
+
+def run_suite_workers(url: str, options: Dict, job: str, peers: int, messages: int, size: int) -> Dict:
+    results = multiprocessing.Queue()
+    start_time = time.monotonic()
+    workers = [multiprocessing.Process(target=suite_worker, args=(url, options, job, peers, messages, size, results))
+               for _ in range(peers)]
+    for worker in workers:
+        worker.start()
+    outcomes = [results.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    latencies = [latency for outcome in outcomes for latency in outcome['latencies']]
+    seconds = max(outcome['seconds'] for outcome in outcomes)
+    total = peers * (peers - 1) * messages
+    return {'peers': peers, 'size': size, 'messages': total, 'seconds': seconds, 'msg/s': total / seconds,
+            'MB/s': total * size / seconds / 2 ** 20, 'p50 latency': percentile(latencies, 50),
+            'p99 latency': percentile(latencies, 99),
+            'registration': max(outcome['registered'] for outcome in outcomes) - start_time,
+            'slowest registration': max(outcome['registration'] for outcome in outcomes)}
+
+
+def suite_pagerank(url: str, root: str, options: Dict, job: str, vertices: int, degree: int, parts: int,
+                   turns: int) -> Dict:
+    """
+    client.py on shards of a synthetic graph, invoked like invoker.py --mode async --local does
+    """
+    files = [text.encode() for text in synthetic_graph(vertices, degree, parts)]
+    graph = pagerank.Graph.load(files[0], files[2], files[1])
+    store = local.LocalStore(root)
+    event = invoker.make_event(parts, job)
+    store.upload_fileobj(io.BytesIO(graphfile.pack(graph.arrays())), event['bucket'], event['dataset'])
+    store.upload_fileobj(io.BytesIO(graphfile.pack({'partition': graph.partition})), event['bucket'],
+                         event['partition'])
+    for uid in range(1, parts + 1):
+        store.upload_fileobj(io.BytesIO(graphfile.pack(pagerank.CsrSubgraph.from_graph(graph, uid).shard())),
+                             event['bucket'], f'{event["shard"]}_{uid}')
+    event.update(url=url, rounds=turns, store=root)
+    event['forwarder'].update(options)
+    lambda_client = local.LocalLambda()
+    start_time = time.perf_counter()
+    summaries, ranks, _ = invoker.run_async(lambda_client, store, event, parts, timeout=600)
+    seconds = time.perf_counter() - start_time
+    lambda_client.join()
+    done = [summary for summary in summaries if summary.get('statusCode') == 200]
+    if len(done) < parts:
+        raise RuntimeError(f'{parts - len(done)} instances failed: {[s.get("Exception") for s in summaries]}')
+    init = {phase: max(summary['init'][phase] for summary in done) for phase in done[0]['init'] if phase != 'run'}
+    return {'vertices': vertices, 'edges': len(graph.targets), 'parts': parts, 'turns': turns, 'seconds': seconds,
+            'seconds per turn': max(summary['init']['run'] for summary in done) / turns, 'init': init,
+            'rank sum': float(np.nansum(ranks))}
+
+
+def bench_suite(args):
+    """
+    every result is a line of JSON appended to args.output, so that runs can be compared
+    """
+    root = tempfile.mkdtemp(prefix='benchmark-s3-')
+    server = start_server(args.port, max(args.peers))
+    url = f'http://127.0.0.1:{args.port}'
+    environment = {'python': sys.version.split()[0], 'numpy': np.__version__, 'cpus': os.cpu_count(),
+                   'platform': sys.platform, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    results: List[Dict] = []
+    try:
+        for mode in args.modes:
+            for peers in args.peers:
+                for size in args.sizes:
+                    result = run_suite_workers(url, MODES[mode], f'suite-{mode}-{peers}-{size}', peers,
+                                               args.messages, size)
+                    results.append({'benchmark': 'messages', 'mode': mode, **result})
+                    print(f'{mode:<16} {peers:>3} peers {size:>7} B: {result["msg/s"]:8.0f} msg/s, '
+                          f'{result["MB/s"]:7.1f} MB/s, latency p50 {result["p50 latency"] * 1000:.2f} ms, '
+                          f'p99 {result["p99 latency"] * 1000:.2f} ms, registration {result["registration"]:.2f}s')
+            for peers in args.register_peers:
+                result = run_suite_workers(url, MODES[mode], f'suite-{mode}-register-{peers}', peers, 1, 1)
+                results.append({'benchmark': 'registration', 'mode': mode, 'peers': peers,
+                                'registration': result['registration'],
+                                'slowest registration': result['slowest registration']})
+                print(f'{mode:<16} {peers:>3} peers registered in {result["registration"]:.2f}s')
+            for vertices in args.vertices:
+                result = suite_pagerank(url, root, MODES[mode], f'suite-{mode}-pagerank-{vertices}', vertices,
+                                        args.degree, args.parts, args.turns)
+                results.append({'benchmark': 'pagerank', 'mode': mode, **result})
+                print(f'{mode:<16} pagerank {vertices} vertices, {args.parts} parts: '
+                      f'{result["seconds per turn"] * 1000:.1f} ms per turn, {result["seconds"]:.2f}s in total')
+    finally:
+        stop_server(server)
+        shutil.rmtree(root, ignore_errors=True)
+    with open(args.output, 'a') as output:
+        for result in results:
+            output.write(json.dumps({**environment, **result}) + '\n')
+    print(f'{len(results)} results appended to {args.output}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    direct_parser = subparsers.add_parser('direct', help='throughput of the direct data plane against the relay')
+    direct_parser.add_argument('--peers', type=int, default=4)
+    direct_parser.add_argument('--messages', type=int, default=200, help='messages each peer sends to each peer')
+    direct_parser.add_argument('--size', type=int, default=1024, help='payload size in bytes')
+    direct_parser.add_argument('--batch-size', type=int, default=1)
+    direct_parser.set_defaults(func=bench_direct)
+
+    shards_parser = subparsers.add_parser('shards', help='relayed message rate against the number of server shards')
+    shards_parser.add_argument('--max-shards', type=int, default=4)
+    shards_parser.add_argument('--peers', type=int, default=16)
+    shards_parser.add_argument('--messages', type=int, default=50, help='messages each peer sends to each peer')
+    shards_parser.add_argument('--size', type=int, default=256, help='payload size in bytes')
+    shards_parser.add_argument('--batch-size', type=int, default=64)
+    shards_parser.set_defaults(func=bench_shards)
+
+    pagerank_parser = subparsers.add_parser('pagerank', help='per turn time of the csr and the dict PageRank kernel')
+    pagerank_parser.add_argument('--dataset',
+                                 help='dataset written by preprocess.py (text or binary), a synthetic graph if omitted')
+    pagerank_parser.add_argument('--r-dataset', help='defaults to r_<dataset>, only read for a text dataset')
+    pagerank_parser.add_argument('--partition')
+    pagerank_parser.add_argument('--vertices', type=int, default=100000)
+    pagerank_parser.add_argument('--degree', type=int, default=10, help='average out-degree')
+    pagerank_parser.add_argument('--parts', type=int, default=8)
+    pagerank_parser.add_argument('--turns', type=int, default=5)
+    pagerank_parser.add_argument('--tolerance', type=float, default=1e-3,
+                                 help='relative change of a rank below which the csr kernel does not send it again')
+    pagerank_parser.set_defaults(func=bench_pagerank)
+
+    staleness_parser = subparsers.add_parser('staleness', help='time to accuracy of lock step and bounded staleness')
+    staleness_parser.add_argument('--vertices', type=int, default=20000)
+    staleness_parser.add_argument('--degree', type=int, default=10, help='average out-degree')
+    staleness_parser.add_argument('--parts', type=int, default=4)
+    staleness_parser.add_argument('--staleness', type=int, nargs='+', default=[0, 1, 2])
+    staleness_parser.add_argument('--threshold', type=float, default=1e-6, help='residual at which the workers stop')
+    staleness_parser.add_argument('--turns', type=int, default=500, help='turns at most')
+    staleness_parser.add_argument('--damping', type=float, default=0.85)
+    staleness_parser.add_argument('--dangling', choices=pagerank.DANGLING, default='uniform')
+    staleness_parser.add_argument('--jitter', type=float, default=0.02, help='mean delay of a turn in seconds')
+    staleness_parser.add_argument('--relay', action='store_true', help='messages over server.py, not the direct plane')
+    staleness_parser.set_defaults(func=bench_staleness)
+
+    partition_parser = subparsers.add_parser('partition', help='edge cut and communication volume of the partitioners')
+    partition_parser.add_argument('--vertices', type=int, default=100000)
+    partition_parser.add_argument('--degree', type=int, default=10, help='average out-degree')
+    partition_parser.add_argument('--parts', type=int, default=8)
+    partition_parser.set_defaults(func=bench_partition)
+
+    suite_parser = subparsers.add_parser('suite', help='message rate, latency, registration and PageRank of the modes '
+                                                       'of the forwarder, appended to a JSON lines file')
+    suite_parser.add_argument('--modes', choices=MODES, nargs='+', default=['binary-process', 'binary-thread',
+                                                                           'direct-thread'])
+    suite_parser.add_argument('--peers', type=int, nargs='+', default=[2, 4], help='at least 2')
+    suite_parser.add_argument('--sizes', type=int, nargs='+', default=[64, 4096, 65536], help='payload sizes in bytes')
+    suite_parser.add_argument('--messages', type=int, default=100, help='messages each peer sends to each peer')
+    suite_parser.add_argument('--register-peers', type=int, nargs='+', default=[2, 4, 8, 16])
+    suite_parser.add_argument('--vertices', type=int, nargs='+', default=[20000, 100000])
+    suite_parser.add_argument('--degree', type=int, default=10, help='average out-degree')
+    suite_parser.add_argument('--parts', type=int, default=4)
+    suite_parser.add_argument('--turns', type=int, default=10)
+    suite_parser.add_argument('--output', default='benchmark.jsonl')
+    suite_parser.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -1,12 +1,16 @@
+import collections
 import io
 import json
 import logging
 import time
-from itertools import chain
-from typing import List, Tuple, Dict, Set, Callable
+from typing import Callable, Dict, List, Optional, Tuple
 
 import boto3
+from botocore.exceptions import ClientError
 
+import graphfile
+import local
+import pagerank
 import softwareforwarder
 
 FORMAT = f"%(filename)-13s|%(funcName)-10s|%(lineno)-3d|%(message)s"
@@ -14,6 +18,92 @@ logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# sub-graphs set up by the invocations before, while Lambda keeps the container warm. An invocation over the same
+# objects of S3 skips download and initialization. At most GRAPH_CACHE_SIZE are kept, least recently used first.
+GRAPH_CACHE_SIZE = 2
+graphs: Dict[Tuple, object] = collections.OrderedDict()
+
+
+def shard_key(s3, event: dict, uid: int, kernel: str) -> Optional[str]:
+    """
+    :return: key of the shard of sub-graph uid, None if the event names no shards, the kernel does not use them or
+    preprocess.py did not write them (text output), dataset and partition are downloaded then
+    """
+    if not event.get('shard') or kernel != 'csr':
+        return None
+    key = f'{event["shard"]}_{uid}'
+    try:
+        s3.head_object(Bucket=event['bucket'], Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+            raise
+        logger.warning(f'shard {key} does not exist, download dataset and partition instead')
+        return None
+    return key
+
+
+def load(s3, event: dict, uid: int, shard_key: Optional[str], kernel: str, options: Dict, timer):
+    """
+    download the graph of sub-graph uid and set it up
+    :param shard_key: see shard_key()
+    """
+    if shard_key is not None:
+        # only the sub-graph of this instance, written by preprocess.py
+        shard = io.BytesIO()
+        s3.download_fileobj(event["bucket"], shard_key, shard)
+        timer.lap('download')
+
+        logger.info('page rank initialization start')
+
+        graph = graphfile.read(shard.getbuffer())
+        timer.lap('load')
+    else:
+        dataset = io.BytesIO()
+        s3.download_fileobj(event["bucket"], event["dataset"], dataset)
+
+        partition = io.BytesIO()
+        s3.download_fileobj(event["bucket"], event["partition"], partition)
+
+        # a binary graph container already holds the reverse graph, the text format needs r_dataset
+        r_dataset = None
+        if not graphfile.is_container(dataset.getbuffer()):
+            r_dataset = io.BytesIO()
+            s3.download_fileobj(event["bucket"], event["r_dataset"], r_dataset)
+            r_dataset = r_dataset.getbuffer()
+        timer.lap('download')
+
+        logger.info('page rank initialization start')
+
+        # the arrays of binary containers share memory with the downloaded buffers
+        graph = pagerank.Graph.load(dataset.getbuffer(), partition.getbuffer(), r_dataset)
+        timer.lap('load')
+    return pagerank.load_subgraph(kernel, graph, uid, **options)
+
+
+def cache_key(s3, event: dict, uid: int, shard_key: Optional[str], kernel: str, options: Dict) -> Tuple:
+    """
+    the ETag of an object changes whenever it is written again. r_dataset is derived from dataset and left out.
+    """
+    if shard_key is not None:
+        keys = (shard_key,)
+    else:
+        keys = (event['dataset'], event['partition'])
+    etags = tuple(s3.head_object(Bucket=event['bucket'], Key=key)['ETag'] for key in keys)
+    return event['bucket'], keys, etags, uid, kernel, tuple(sorted(options.items()))
+
+
+def cached_uid(event: dict) -> Optional[int]:
+    """
+    :return: uid of the most recently used cached sub-graph of the graph of event, asked for at registration
+    """
+    if not event.get('cache', True):
+        return None
+    for bucket, keys, _, uid, kernel, _ in reversed(graphs):
+        if bucket == event['bucket'] and kernel == event.get('kernel', 'csr') and \
+                keys in ((f'{event.get("shard")}_{uid}',), (event['dataset'], event['partition'])):
+            return uid
+    return None
+
 
 def lambda_handler(event: dict, context: dict):
     """
@@ -22,7 +112,10 @@ def lambda_handler(event: dict, context: dict):
     """
     start_time = time.time()
     try:
-        @softwareforwarder.SoftwareForwarder(url=event['url'])
+        # a warm container asks for the sub-graph it still has
+        forwarder = {'prefer_uid': cached_uid(event), **event.get('forwarder', {})}
+
+        @softwareforwarder.SoftwareForwarder(url=event['url'], **forwarder)
         def main(event, context):
             sen: Callable = event['sen']
             rec: Callable = event['rec']
@@ -37,120 +130,81 @@ def lambda_handler(event: dict, context: dict):
              each iteration, instances exchange information with other instances. As long as an instance receives enough 
             information, the next iteration will start.
             """
-            s3 = boto3.client('s3')
+            # a directory standing in for S3 when the instances run locally, see local.py
+            s3 = local.LocalStore(event['store']) if event.get('store') else boto3.client('s3')
 
             logger.info(f'''bucket = {event["bucket"]}\ndataset = {event["dataset"]}\n
-            r_dataset={event["r_dataset"]}\npartition= {event["partition"]}''')
+            r_dataset={event["r_dataset"]}\npartition= {event["partition"]}\nshard= {event.get("shard")}''')
 
             logger.info(f'data files downloading start')
+            # seconds of every phase of the initialization, reported with the result
+            timer = pagerank.Timer()
 
-            dataset = io.BytesIO()
-            s3.download_fileobj(event["bucket"], event["dataset"], dataset)
-
-            r_dataset = io.BytesIO()
-            s3.download_fileobj(event["bucket"], event["r_dataset"], r_dataset)
-
-            partition = io.BytesIO()
-            s3.download_fileobj(event["bucket"], event["partition"], partition)
-
-            dataset = dataset.getvalue().decode()
-            r_dataset = r_dataset.getvalue().decode()
-            partition = tuple(map(lambda x: int(str.strip(x)), partition.getvalue().decode().split('\n')))
             turns = range(1, 1 + event['rounds'])
-
-            logger.info('page rank initialization start')
-
-            lines = dataset.split('\n')[:-1]
-            r_lines = r_dataset.split('\n')[:-1]
-            """
-            v: vertex
-            e: edge
-            sg: sub-graph
-            in: internal
-            co: correlated
-            """
-            outgo_es = tuple(tuple(map(int, lines[i].strip().split(' ')) if lines[i] != '' else (i + 1,))
-                             for i in range(len(lines)))
-            logger.debug(f'outgo_es = {outgo_es}')
-
-            in_vs = tuple(i + 1 for i in range(len(partition)) if partition[i] == uid)
-            logger.debug(f'in_vs = {in_vs}')
-
-            in_v__outgo_sgs_map = {v: tuple({partition[e - 1] for e in outgo_es[v - 1] if partition[e - 1] != uid})
-                                   for v in in_vs}
-            logger.debug(f'in_v__outgo_sgs_map = {in_v__outgo_sgs_map}')
-
-            outgo_sg__in_vs_map = {
-                sg: tuple(filter(lambda _in_v: sg in in_v__outgo_sgs_map[_in_v], in_v__outgo_sgs_map))
-                for sg in set(chain.from_iterable(in_v__outgo_sgs_map.values()))}
-            logger.debug(f'outgo_sg__in_vs_map = {outgo_sg__in_vs_map}')
-
-            in_v__income_es_idx_map = \
-                {_in_v: tuple(map(int, (('' if outgo_es[_in_v - 1] != (_in_v,) else f'{_in_v} ') + r_lines[_in_v - 1])
-                                  .strip().split(' '))) for _in_v in in_vs if r_lines[_in_v - 1] != ''}
-            logger.debug(f'in_v__income_es_idx_map = {in_v__income_es_idx_map}')
-
-            co_vs = tuple(set(chain.from_iterable(in_v__income_es_idx_map.values())))
-            co_v__outgo_es_num_map = {v: len(outgo_es[v - 1]) for v in co_vs}
-            logger.debug(f'co_v__outgo_es_num_map = {co_v__outgo_es_num_map}')
-
-            pagerank = {v: 1 for v in set(co_vs + in_vs)}
-            # message buffer := {turn:[msg_update1,msg_update2],}
-            msg_buff: Dict[int, List[Tuple]] = {}
+            kernel = event.get('kernel', 'csr')
+            # how the csr kernel packs its messages and computes the ranks
+            options = {name: event[name] for name in ('precision', 'tolerance', 'damping', 'dangling_policy')
+                       if name in event}
+
+            shard = shard_key(s3, event, uid, kernel)
+            key = cache_key(s3, event, uid, shard, kernel, options) if event.get('cache', True) else None
+            timer.lap('head')
+            subgraph = graphs.pop(key, None)
+            if subgraph is not None:
+                logger.info('page rank initialization skipped, the sub-graph is cached')
+                subgraph.reset()
+                timer.lap('reset')
+                init = dict(timer.phases)
+            else:
+                # the least recently used sub-graphs are freed before the download
+                while graphs and len(graphs) >= GRAPH_CACHE_SIZE:
+                    graphs.popitem(last=False)
+                subgraph = load(s3, event, uid, shard, kernel, options, timer)
+                init = {**timer.phases, **subgraph.timings}
+            if key is not None and GRAPH_CACHE_SIZE:
+                graphs[key] = subgraph
+            logger.info('page rank initialization ' + ', '.join(f'{phase} {seconds:.3f}s'
+                                                               for phase, seconds in init.items()))
 
             logger.info(f'page rank calculation start')
 
-            for turn in turns:
-                logger.info(f'uid {uid} start turn {turn}!\n' + '=' * 60)
-                _pagerank = {v: 0 for v in set(co_vs + in_vs)}
-                logger.debug(f'pagerank = {pagerank}')
-                """Calculate pagerank"""
-                for _in_v in in_v__income_es_idx_map:
-                    for _co_v in in_v__income_es_idx_map[_in_v]:
-                        _pagerank[_in_v] += pagerank[_co_v] / co_v__outgo_es_num_map[_co_v]
-
-                """Send pagerank"""
-                # msg_update := (turn,{vertex1:pagerank1,vertex2:pagerank2,})
-                for _sg, _vs in outgo_sg__in_vs_map.items():
-                    msg_update: Tuple[int, Dict] = (turn, {_v: _pagerank[_v] for _v in _vs})
-                    logger.debug(f'_sg = {_sg}, msg_update = {msg_update}')
-                    sen(_sg, msg_update)
-
-                """Receive pagerank"""
-                vs_wait: Set[int] = set(co_vs)
-                vs_wait.difference_update(in_vs)
-                while vs_wait:
-                    if turn in msg_buff:  # check if any msg_update of this turn left in msg_buff
-                        msg_update: Tuple[int, Dict] = msg_buff[turn].pop()
-                        if not msg_buff[turn]:
-                            del msg_buff[turn]
-                    else:
-                        msg_update: Tuple[int, Dict] = rec()
-                        if msg_update[0] != turn:  # msg_update is of another turn, buffer it
-                            if msg_update[0] in msg_buff:
-                                msg_buff[msg_update[0]].append(msg_update)
-                            else:
-                                msg_buff[msg_update[0]] = [msg_update]
-                            continue
-
-                    """Update pagerank"""
-                    _pagerank.update(msg_update[1])
-                    vs_wait.difference_update(msg_update[1].keys())
-
-                pagerank = _pagerank
-
-                logger.debug(f'uid {uid} turn {turn} finish, page rank = {pagerank}')
-
-            return uid, pagerank
-
-        uid, result, = main(event, context)
+            # seconds of every turn by phase, kept along with the counters of the forwarder unless they are disabled
+            metrics = event['metrics']
+            profile = [] if metrics is not None else None
+            run_start = time.time()
+            done = pagerank.run(subgraph, sen, rec, turns, staleness=event.get('staleness', 0),
+                                threshold=event.get('threshold', 0.0), allreduce=event['allreduce'], profile=profile)
+            init['run'] = time.time() - run_start
+            summary = None
+            if metrics is not None:
+                phases = ('compute', 'send', 'wait', 'reduce')
+                summary = {'forwarder': metrics.summary(),
+                           'turns': {phase: [turn.get(phase, 0.0) for turn in profile] for phase in phases},
+                           'total': {phase: sum(turn.get(phase, 0.0) for turn in profile) for phase in phases}}
+                logger.info('uid %d: compute %.3fs, send %.3fs, wait %.3fs, reduce %.3fs', uid,
+                            *(summary['total'][phase] for phase in phases))
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'uid {uid} finish, page rank = {subgraph.result()}')
+
+            if event.get('result'):
+                # the ranks of the internal vertices as binary arrays, the response of Lambda is limited to 6MB
+                key = f'{event["result"]}_{uid}'
+                vertices, ranks = subgraph.ranks()
+                s3.upload_fileobj(io.BytesIO(graphfile.pack({'vertices': vertices, 'ranks': ranks})),
+                                  event['bucket'], key)
+                return uid, {'result': key}, done, init, summary
+            return uid, {'res': subgraph.result()}, done, init, summary
+
+        uid, result, done, init, summary = main(event, context)
         duration = time.time() - start_time
 
-        # TODO maximum of return data is 6MB, it might be better to put result to S3blacks
-
-        return {
+        response = {
             'uid': uid,
-            'res': result,
+            **result,
+            'turns': done,
+            'init': init,
+            'metrics': summary,
             'statusCode': 200,
             'body': json.dumps('Hello from Lambda!'),
             'duration': duration,
@@ -159,9 +213,18 @@ def lambda_handler(event: dict, context: dict):
     except Exception as e:
         duration = time.time() - start_time
         err = str(e)
-        return {
+        response = {
             'Exception': err,
             'statusCode': 400,
             'body': json.dumps('Something wrong from Lambda!'),
             'duration': duration,
         }
+
+    if event.get('result'):
+        # invoked asynchronously, invoker.py waits for the summary of every instance on the server
+        try:
+            softwareforwarder.report_completion(event['url'], event.get('forwarder', {}).get('job', 'default'),
+                                                response)
+        except Exception as e:
+            logger.error(f'completion of the instance could not be reported: {e}')
+    return response
@@ -0,0 +1,84 @@
+"""
+Binary container of the arrays written by preprocess.py and loaded by client.py, it has to be deployed together with
+both of them.
+
+A container is a HEADER, one ARRAY_HEADER per array and the data of the arrays, every array starts at a multiple of
+ALIGNMENT bytes. Arrays are stored little-endian and loaded with numpy.frombuffer, without copy or parsing.
+
+The graph container holds the CSR arrays of the graph:
+offsets, targets: vertex v (counted from 1) links to targets[offsets[v - 1]:offsets[v]]
+r_offsets, sources: vertex v is linked from sources[r_offsets[v - 1]:r_offsets[v]]
+The partition container holds partition: sub-graph of every vertex.
+"""
+import io
+import mmap
+import struct
+from typing import BinaryIO, Dict, Union
+
+import numpy as np
+
+MAGIC = b'PRGRAPH1'
+# magic, number of arrays
+HEADER = struct.Struct('<8sI')
+# name, dtype (numpy type string, e.g. '<i4'), offset of the data from the start of the container, number of items
+ARRAY_HEADER = struct.Struct('<16s8sQQ')
+ALIGNMENT = 64
+
+GRAPH_ARRAYS = ('offsets', 'targets', 'r_offsets', 'sources')
+PARTITION_ARRAYS = ('partition',)
+
+
+def is_container(buffer: Union[bytes, memoryview]) -> bool:
+    return bytes(buffer[:len(MAGIC)]) == MAGIC
+
+
+def dump(file: BinaryIO, arrays: Dict[str, np.ndarray]):
+    """
+    write the container to a binary file object, array by array without copying them
+    """
+    arrays = {name: np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('<')) for name, array in arrays.items()}
+    offset = HEADER.size + ARRAY_HEADER.size * len(arrays)
+    headers, paddings = [HEADER.pack(MAGIC, len(arrays))], []
+    for name, array in arrays.items():
+        paddings.append(-offset % ALIGNMENT)
+        offset += paddings[-1]
+        headers.append(ARRAY_HEADER.pack(name.encode('ascii'), array.dtype.str.encode('ascii'), offset, array.size))
+        offset += array.nbytes
+    file.write(b''.join(headers))
+    for padding, array in zip(paddings, arrays.values()):
+        file.write(b'\0' * padding)
+        file.write(memoryview(array).cast('B'))
+
+
+def pack(arrays: Dict[str, np.ndarray]) -> bytes:
+    buffer = io.BytesIO()
+    dump(buffer, arrays)
+    return buffer.getvalue()
+
+
+def write(path: str, arrays: Dict[str, np.ndarray]):
+    with open(path, 'wb') as file:
+        dump(file, arrays)
+
+
+def read(buffer: Union[bytes, memoryview, mmap.mmap]) -> Dict[str, np.ndarray]:
+    """
+    :return: read-only arrays sharing memory with buffer
+    """
+    magic, count = HEADER.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('not a dataset container')
+    arrays = {}
+    for i in range(count):
+        name, dtype, offset, size = ARRAY_HEADER.unpack_from(buffer, HEADER.size + ARRAY_HEADER.size * i)
+        arrays[name.rstrip(b'\0').decode('ascii')] = \
+            np.frombuffer(buffer, dtype=np.dtype(dtype.rstrip(b'\0').decode('ascii')), count=size, offset=offset)
+    return arrays
+
+
+def load(path: str) -> Dict[str, np.ndarray]:
+    """
+    map the container file into memory, pages are read on first access
+    """
+    with open(path, 'rb') as file:
+        return read(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
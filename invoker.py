@@ -1,21 +1,26 @@
-import ast
+import argparse
+import io
 import json
-import sys
 import time
 from multiprocessing.pool import ThreadPool
+from typing import Dict, List, Tuple
 
+import boto3
 import botocore.config
 import botocore.session
+import numpy as np
+
+import graphfile
+import local
+import softwareforwarder
 
-session = botocore.session.get_session()
 region_name = 'us-east-1'
 lambda_function_name = 'client'
 cfg = botocore.config.Config(retries={'max_attempts': 0}, connect_timeout=300, read_timeout=300)
-lambda_client = session.create_client('lambda', region_name=region_name, config=cfg)
 
 """
 This is the script to invoke many lambda function instances, each instance just is responsible for a part of graph.
-So I aggregate the return results for convenience 
+So I aggregate the return results for convenience
 
 here is a example of what dataset and related partition looks like
 dataset = r'''2
@@ -36,58 +41,181 @@ partition = r'''1
 3
 3
 3'''
+
+sync: every instance is invoked synchronously by its own thread and returns its ranks in the response of Lambda,
+which is limited to 6MB
+async: the instances are invoked with InvocationType 'Event' and write the ranks of their sub-graph as binary arrays
+to S3, <result>_<uid>. Every instance reports its completion to server.py, the ranks are then downloaded and reduced
+in parallel. Turn off the retries of asynchronous invocations of the function, a retried instance would register again.
+
+e.g. 20 instances on AWS, or 4 local processes with server.py on 127.0.0.1 and a directory standing in for S3
+python invoker.py 20 --mode async
+python invoker.py 4 --mode async --local /tmp/s3 --url http://127.0.0.1:8000
 """
 
 # PEERS_NUM is the number of lambda function instances, it must be same as the number of sub-graph
-PEERS_NUM = 100 if len(sys.argv) == 1 else int(sys.argv[1])
-print(f'PEERS_NUM = {PEERS_NUM}')
+PEERS_NUM = 100
 url = 'http://172.31.20.160:8000'
 dataset = 'soc-pokec_dataset'
 # dataset = 'test1_dataset'
 r_dataset = f'r_{dataset}'
-partition = f'{dataset}_partition_{PEERS_NUM}'
 bucket = 'pagerankdataset'
-# number of iterations
+# number of iterations, at most if the event has a threshold
 rounds = 1
-
-event = {
-    "bucket": bucket,
-    "dataset": dataset,
-    "r_dataset": r_dataset,
-    "partition": partition,
-    "url": url,
-    "rounds": rounds,
-}
-
-
-def invoke(function_name, payload):
-    return lambda_client.invoke(FunctionName=function_name, Payload=json.dumps(payload),
-                                # InvocationType='Event'
-                                )
-
-
-pool = ThreadPool(PEERS_NUM)
-
-start_time = time.time()
-res = [pool.apply_async(invoke, (lambda_function_name, event)) for i in range(1, PEERS_NUM + 1)]
-
-# get page rank results
-key_values = {}
-for re in res:
-    try:
-        # maximum allowed payload size is 6291556 bytes
-        r = re.get()['Payload'].read().decode()
-        key_values.update(ast.literal_eval(r)['res'])
-    except KeyError as e:
-        print(e)
-        print(r)
-
-print(f'time cost = {time.time() - start_time}')
-try:
-    values = key_values.values()
-    print(f'sum = {sum(values)}, max = {max(values)}, min = {min(values)}')
-except Exception as e:
-    print(e)
-    print(values)
-
-# print(key_values)
+# threads invoking the instances asynchronously, an invocation returns as soon as Lambda queued it
+INVOKE_THREADS = 32
+# threads downloading and reducing the results of the instances
+GATHER_THREADS = 16
+
+
+def make_event(peers_num: int, job: str) -> dict:
+    partition = f'{dataset}_partition_{peers_num}'
+    # instance uid downloads only <shard>_<uid> written by preprocess.py. None, or a shard that does not exist (text
+    # output of preprocess.py), downloads the whole dataset and partition
+    shard = f'{dataset}_shard_{peers_num}'
+    return {
+        "bucket": bucket,
+        "dataset": dataset,
+        "r_dataset": r_dataset,
+        "partition": partition,
+        "shard": shard,
+        "url": url,
+        "rounds": rounds,
+        # PageRank kernel of pagerank.py, 'csr' (NumPy arrays) or 'dict' (the original pure Python one)
+        "kernel": "csr",
+        # ranks sent by the csr kernel, 'float32' halves the bytes of a message
+        "precision": "float64",
+        # ranks whose relative change since they were last sent is at most tolerance are not sent, 0 sends all of them
+        "tolerance": 0.0,
+        # damping factor of PageRank, 1 computes it without damping
+        "damping": 1.0,
+        # rank of vertices without outgoing edge: 'self' keeps it, 'uniform' spreads it over all vertices, 'drop' loses
+        # it
+        "dangling_policy": "self",
+        # turns the ranks received from other instances may lag behind, 0 runs in lock step
+        "staleness": 0,
+        # stop once the ranks change by at most threshold per vertex in a turn, 0 runs all the rounds
+        "threshold": 0.0,
+        # a warm instance keeps the sub-graph of its invocation before and skips download and initialization
+        "cache": True,
+        # keyword arguments of SoftwareForwarder, e.g. {"transport": "websocket"} or {"direct": True}
+        "forwarder": {
+            # registration returns once all PEERS_NUM instances of this run have registered
+            "job": job,
+            "size": peers_num,
+        },
+    }
+
+
+def invoke(lambda_client, payload: dict, invocation_type: str = 'RequestResponse'):
+    return lambda_client.invoke(FunctionName=lambda_function_name, Payload=json.dumps(payload),
+                                InvocationType=invocation_type)
+
+
+def run_sync(lambda_client, event: dict, peers_num: int) -> Dict[int, float]:
+    pool = ThreadPool(peers_num)
+    res = [pool.apply_async(invoke, (lambda_client, event)) for i in range(1, peers_num + 1)]
+
+    # get page rank results
+    key_values = {}
+    for re in res:
+        try:
+            # maximum allowed payload size is 6291556 bytes
+            r = re.get()['Payload'].read().decode()
+            key_values.update(json.loads(r)['res'])
+        except KeyError as e:
+            print(e)
+            print(r)
+    pool.close()
+    return key_values
+
+
+def gather_part(store, key: str) -> Tuple[np.ndarray, np.ndarray, Tuple[float, float, float]]:
+    """
+    :return: vertices and ranks written by an instance, and their sum, max and min
+    """
+    buffer = io.BytesIO()
+    store.download_fileobj(bucket, key, buffer)
+    arrays = graphfile.read(buffer.getbuffer())
+    ranks = arrays['ranks']
+    return arrays['vertices'], ranks, (float(ranks.sum()), float(ranks.max(initial=-np.inf)),
+                                       float(ranks.min(initial=np.inf)))
+
+
+def gather(store, keys: List[str], threads: int = GATHER_THREADS) -> Tuple[np.ndarray, Tuple[float, float, float]]:
+    """
+    download and reduce the results of the instances in parallel
+    :return: rank of every vertex (vertex v at index v - 1, NaN if no instance computed it), sum, max and min
+    """
+    with ThreadPool(min(threads, max(len(keys), 1))) as pool:
+        parts = pool.starmap(gather_part, [(store, key) for key in keys])
+    nodes_num = max((int(vertices.max(initial=0)) for vertices, _, _ in parts), default=0)
+    ranks = np.full(nodes_num, np.nan)
+    for vertices, values, _ in parts:
+        ranks[vertices.astype(np.int64) - 1] = values
+    sums, maxima, minima = zip(*(stats for _, _, stats in parts)) if parts else ((0.0,), (np.nan,), (np.nan,))
+    return ranks, (sum(sums), max(maxima), min(minima))
+
+
+def run_async(lambda_client, store, event: dict, peers_num: int,
+              timeout: float) -> Tuple[List[Dict], np.ndarray, Tuple[float, float, float]]:
+    """
+    :return: summaries reported by the instances, rank of every vertex, sum, max and min of the ranks
+    """
+    job = event['forwarder']['job']
+    event = dict(event, result=f'{dataset}_result_{job}')
+    with ThreadPool(min(peers_num, INVOKE_THREADS)) as pool:
+        pool.starmap(invoke, [(lambda_client, event, 'Event')] * peers_num)
+    print(f'{peers_num} instances invoked')
+
+    summaries = softwareforwarder.wait_completions(event['url'], job, peers_num, timeout)
+    failed = [summary for summary in summaries if summary.get('statusCode') != 200]
+    for summary in failed:
+        print(f'instance failed: {summary.get("Exception")}')
+    if len(summaries) < peers_num:
+        print(f'{peers_num - len(summaries)} instances did not report completion within {timeout}s')
+    durations = [summary['duration'] for summary in summaries if summary.get('statusCode') == 200]
+    if durations:
+        print(f'instances done in {min(durations):.2f}s to {max(durations):.2f}s')
+    ranks, stats = gather(store, [summary['result'] for summary in summaries if summary.get('statusCode') == 200])
+    return summaries, ranks, stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('peers', nargs='?', type=int, default=PEERS_NUM,
+                        help='number of instances, the same as the number of sub-graphs')
+    parser.add_argument('--mode', choices=('sync', 'async'), default='sync')
+    parser.add_argument('--url', default=url, help='base url of server.py')
+    parser.add_argument('--timeout', type=float, default=900.0,
+                        help='seconds to wait for the instances to complete, async mode only')
+    parser.add_argument('--local', metavar='DIR', help='run the instances as local processes, DIR stands in for S3')
+    args = parser.parse_args()
+    PEERS_NUM = args.peers
+    print(f'PEERS_NUM = {PEERS_NUM}')
+
+    event = make_event(PEERS_NUM, f'pagerank-{int(time.time())}')
+    event['url'] = args.url
+    if args.local:
+        lambda_client, store = local.LocalLambda(), local.LocalStore(args.local)
+        event['store'] = args.local
+    else:
+        session = botocore.session.get_session()
+        lambda_client = session.create_client('lambda', region_name=region_name, config=cfg)
+        store = boto3.client('s3')
+
+    start_time = time.time()
+    if args.mode == 'sync':
+        values = list(run_sync(lambda_client, event, PEERS_NUM).values())
+        print(f'time cost = {time.time() - start_time}')
+        try:
+            print(f'sum = {sum(values)}, max = {max(values)}, min = {min(values)}')
+        except Exception as e:
+            print(e)
+            print(values)
+    else:
+        _, ranks, (total, maximum, minimum) = run_async(lambda_client, store, event, PEERS_NUM, args.timeout)
+        print(f'time cost = {time.time() - start_time}')
+        print(f'sum = {total}, max = {maximum}, min = {minimum}, vertices = {int(np.count_nonzero(~np.isnan(ranks)))}')
+    if args.local:
+        lambda_client.join()
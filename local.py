@@ -0,0 +1,132 @@
+"""
+Stand-ins of AWS Lambda and S3 to run preprocess.py, invoker.py and client.py on one machine, together with server.py
+listening on 127.0.0.1, e.g.
+python server.py --host 127.0.0.1 --peers 4
+python preprocess.py 4 --store /tmp/s3
+python invoker.py 4 --local /tmp/s3 --url http://127.0.0.1:8000
+
+LocalStore: the methods of the S3 client used by this repository, the object <key> of <bucket> is the file
+<root>/<bucket>/<key>, its ETag and metadata are kept in <root>/.metadata/<bucket>/<key>
+LocalLambda: the invoke method of the Lambda client, every invocation runs lambda_handler of the module named like the
+function in a new process
+"""
+import hashlib
+import importlib
+import io
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import uuid
+from typing import BinaryIO, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+# read and hashed at once when a file is stored
+BLOCK = 2 ** 20
+
+
+class LocalStore(object):
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, key)
+
+    def metadata_path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, '.metadata', bucket, key)
+
+    @staticmethod
+    def not_found(operation: str, bucket: str, key: str) -> ClientError:
+        # what boto3 raises, so that callers handle missing objects the same way
+        return ClientError({'Error': {'Code': '404', 'Message': f'Not Found: {bucket}/{key}'}}, operation)
+
+    def upload_fileobj(self, Fileobj: BinaryIO, Bucket: str, Key: str, ExtraArgs: Optional[Dict] = None):
+        """
+        the object is replaced at once, readers in other processes never see part of it
+        """
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        md5 = hashlib.md5()
+        with open(tmp_path, 'wb') as file:
+            for block in iter(lambda: Fileobj.read(BLOCK), b''):
+                md5.update(block)
+                file.write(block)
+        metadata_path = self.metadata_path(Bucket, Key)
+        os.makedirs(os.path.dirname(metadata_path), exist_ok=True)
+        with open(f'{metadata_path}.tmp', 'w') as metadata_file:
+            json.dump({'ETag': f'"{md5.hexdigest()}"', 'Metadata': (ExtraArgs or {}).get('Metadata', {})},
+                      metadata_file)
+        os.replace(tmp_path, path)
+        os.replace(f'{metadata_path}.tmp', metadata_path)
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, ExtraArgs: Optional[Dict] = None):
+        with open(Filename, 'rb') as file:
+            self.upload_fileobj(file, Bucket, Key, ExtraArgs)
+
+    def download_fileobj(self, Bucket: str, Key: str, Fileobj: BinaryIO):
+        try:
+            with open(self.path(Bucket, Key), 'rb') as file:
+                shutil.copyfileobj(file, Fileobj, BLOCK)
+        except FileNotFoundError:
+            raise self.not_found('GetObject', Bucket, Key) from None
+
+    def head_object(self, Bucket: str, Key: str) -> Dict:
+        try:
+            with open(self.metadata_path(Bucket, Key)) as metadata_file:
+                head = json.load(metadata_file)
+            head['ContentLength'] = os.path.getsize(self.path(Bucket, Key))
+        except FileNotFoundError:
+            raise self.not_found('HeadObject', Bucket, Key) from None
+        return head
+
+
+def handle(function_name: str, event: Dict, result: Optional[multiprocessing.connection.Connection]):
+    """
+    body of the process of an invocation, the result of lambda_handler is sent back as JSON like Lambda does
+    """
+    response = importlib.import_module(function_name).lambda_handler(event, None)
+    if result is not None:
+        result.send_bytes(json.dumps(response).encode())
+        result.close()
+    # Lambda ends the invocation once the handler returned, e.g. the loops of a SoftwareForwarder that failed
+    for child in multiprocessing.active_children():
+        child.terminate()
+
+
+class LocalLambda(object):
+    def __init__(self):
+        self.processes: List[multiprocessing.Process] = []
+
+    def invoke(self, FunctionName: str, Payload: str, InvocationType: str = 'RequestResponse') -> Dict:
+        """
+        :param InvocationType: 'Event' returns as soon as the process started, 'RequestResponse' once it returned
+        """
+        event = json.loads(Payload)
+        if InvocationType == 'Event':
+            process = multiprocessing.Process(target=handle, args=(FunctionName, event, None))
+            process.start()
+            self.processes.append(process)
+            return {'StatusCode': 202}
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        # not a daemon, the process engine of SoftwareForwarder starts processes of its own
+        process = multiprocessing.Process(target=handle, args=(FunctionName, event, sender))
+        process.start()
+        sender.close()
+        try:
+            payload = receiver.recv_bytes()
+        except EOFError:  # the process died, Lambda reports it as a function error too
+            process.join()
+            payload = json.dumps({'errorMessage': f'process exited with code {process.exitcode}'}).encode()
+        process.join()
+        return {'StatusCode': 200, 'Payload': io.BytesIO(payload)}
+
+    def join(self, timeout: Optional[float] = None):
+        """
+        wait for the processes of asynchronous invocations
+        """
+        for process in self.processes:
+            process.join(timeout)
+        self.processes = [process for process in self.processes if process.is_alive()]
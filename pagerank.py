@@ -0,0 +1,685 @@
+"""
+PageRank of the sub-graph a worker is responsible for, used by client.py and benchmark.py. Deploy it to AWS Lambda
+together with client.py.
+
+The graph is loaded from the binary containers of graphfile.py, or from the text format:
+dataset: line v lists the vertices v links to, a vertex without outgoing edge links to itself
+r_dataset: line v lists the vertices linking to v
+partition: line v is the sub-graph (uid of the worker) of v
+
+Two kernels compute the same ranks:
+dict: the original implementation on Python dicts, one float division per edge and turn
+csr: the sub-graph compiled into NumPy arrays indexed by local vertex index, one sparse mat-vec per turn
+
+Without damping (the default) the rank of a vertex is the sum of rank / outdegree of the vertices linking to it, and
+a vertex without outgoing edge links to itself. The csr kernel also computes damped PageRank, (1 - damping) + damping
+* that sum, with the rank of vertices without outgoing edge kept (self), spread over all vertices (uniform) or
+dropped (drop), see DANGLING. Only with uniform do the ranks sum up to the number of vertices, with drop that rank
+leaks every turn, and with self the sum is not preserved either.
+
+run() exchanges ranks in lock step (BSP), or with bounded staleness, and stops after a number of turns or once the
+ranks changed less than a threshold.
+
+The csr kernel packs the ranks sent to another sub-graph with RankCodec. The vertices are sent once, in the first
+message, later messages only carry the values in the same order, optionally as float32 and only those that changed.
+
+Both kernels build their send plan, receive plan and local index tables in one pass over the sub-graph, and allocate
+the ranks once, a turn overwrites them in place. The seconds of every phase of the setup are kept in timings.
+"""
+import logging
+import operator
+import queue
+import struct
+import time
+from itertools import chain
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+import graphfile
+
+FORMAT = f"%(filename)-13s|%(funcName)-10s|%(lineno)-3d|%(message)s"
+logging.basicConfig(format=FORMAT)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+Buffer = Union[bytes, memoryview]
+
+# uid of the sending sub-graph, flags, number of values, the header of a message packed by RankCodec
+RANKS_HEADER = struct.Struct('<IBI')
+# flags: the vertices follow the header, the values are float32, positions in the vertex order precede the values
+ORDER = 1
+SINGLE = 2
+SPARSE = 4
+PRECISIONS = {'float64': np.dtype('<f8'), 'float32': np.dtype('<f4')}
+# rank of a vertex without outgoing edge: kept by linking to itself, spread evenly over all vertices, or lost
+DANGLING = ('self', 'uniform', 'drop')
+
+
+class TextGraph(NamedTuple):
+    outgo_es: Tuple[Tuple[int, ...], ...]
+    r_lines: List[str]
+    partition: Tuple[int, ...]
+
+
+def csr_rows(offsets: np.ndarray, values: np.ndarray, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: (position of the row in rows, value) of every value of the given rows of a CSR array
+    """
+    starts = offsets[rows]
+    counts = offsets[rows + 1] - starts
+    row_index = np.repeat(np.arange(len(rows)), counts)
+    positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    return row_index, values[positions]
+
+
+class Timer(object):
+    """
+    seconds spent in every phase of a setup, in order
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.start = time.perf_counter()
+
+    def lap(self, phase: str):
+        """
+        end phase, the next one starts now
+        """
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.start
+        self.start = now
+
+
+class Graph(object):
+    """
+    Whole graph as CSR arrays, vertex v (counted from 1) links to targets[offsets[v - 1]:offsets[v]] and is linked from
+    sources[r_offsets[v - 1]:r_offsets[v]]. Vertices without outgoing edge have no target here.
+    """
+
+    def __init__(self, offsets: np.ndarray, targets: np.ndarray, r_offsets: np.ndarray, sources: np.ndarray,
+                 partition: np.ndarray):
+        self.offsets = offsets
+        self.targets = targets
+        self.r_offsets = r_offsets
+        self.sources = sources
+        self.partition = partition
+
+    @staticmethod
+    def compile_lines(text: str) -> Tuple[np.ndarray, np.ndarray]:
+        counts = np.fromiter((len(line.split()) for line in text.split('\n')[:-1]), dtype=np.int64)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return offsets, np.array(text.split(), dtype=np.int32)
+
+    @classmethod
+    def load(cls, dataset: Buffer, partition: Buffer, r_dataset: Optional[Buffer] = None) -> 'Graph':
+        """
+        :param dataset: graph container of graphfile.py, or text of the dataset
+        :param partition: partition container, or text of the partition
+        :param r_dataset: text of the reverse dataset, only needed if dataset is text
+        """
+        if graphfile.is_container(dataset):
+            arrays = graphfile.read(dataset)
+            offsets, targets, r_offsets, sources = (arrays[name] for name in graphfile.GRAPH_ARRAYS)
+        else:
+            offsets, targets = cls.compile_lines(bytes(dataset).decode())
+            r_offsets, sources = cls.compile_lines(bytes(r_dataset).decode())
+        if graphfile.is_container(partition):
+            partition = graphfile.read(partition)['partition']
+        else:
+            partition = np.array(bytes(partition).split(), dtype=np.int32)
+        return cls(offsets, targets, r_offsets, sources, partition)
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        return {'offsets': self.offsets, 'targets': self.targets, 'r_offsets': self.r_offsets, 'sources': self.sources}
+
+    def text_graph(self) -> TextGraph:
+        """
+        :return: the parsed text format the dict kernel works on
+        """
+        outgo_es = tuple(tuple(targets) if targets else (v,) for v, targets in
+                         enumerate(map(np.ndarray.tolist, np.split(self.targets, self.offsets[1:-1])), 1))
+        r_lines = [' '.join(map(str, sources)) for sources in
+                   map(np.ndarray.tolist, np.split(self.sources, self.r_offsets[1:-1]))]
+        return TextGraph(outgo_es, r_lines, tuple(self.partition.tolist()))
+
+
+class DictSubgraph(object):
+    """
+    v: vertex
+    e: edge
+    sg: sub-graph
+    in: internal
+    co: correlated
+    """
+
+    def __init__(self, graph: TextGraph, uid: int, timer: Optional[Timer] = None):
+        """
+        :param timer: timer of the setup so far, the phases of this one are added to it
+        """
+        outgo_es, r_lines, partition = graph
+        self.uid = uid
+        timer = timer or Timer()
+
+        in_vs = tuple(v for v, sg in enumerate(partition, 1) if sg == uid)
+        self.in_vs = in_vs
+        # only computes PageRank without damping, a vertex without outgoing edge links to itself
+        self.dangling = 'self'
+        timer.lap('index')
+
+        # inverted index of the outgoing edges, every internal vertex is listed once per sub-graph it links to
+        self.outgo_sg__in_vs_map: Dict[int, List[int]] = {}
+        for _in_v in in_vs:
+            for _sg in {partition[e - 1] for e in outgo_es[_in_v - 1]}:
+                if _sg != uid:
+                    self.outgo_sg__in_vs_map.setdefault(_sg, []).append(_in_v)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'outgo_sg__in_vs_map = {self.outgo_sg__in_vs_map}')
+        timer.lap('send plan')
+
+        self.in_v__income_es_idx_map = \
+            {_in_v: tuple(map(int, (('' if outgo_es[_in_v - 1] != (_in_v,) else f'{_in_v} ') + r_lines[_in_v - 1])
+                              .strip().split(' '))) for _in_v in in_vs if r_lines[_in_v - 1] != ''}
+
+        # the correlated vertices of other sub-graphs, by the sub-graph sending their pagerank every turn
+        self.co_v__outgo_es_num_map: Dict[int, int] = {}
+        self.income_sg__co_vs_map: Dict[int, List[int]] = {}
+        for _co_v in set(chain.from_iterable(self.in_v__income_es_idx_map.values())):
+            self.co_v__outgo_es_num_map[_co_v] = len(outgo_es[_co_v - 1])
+            if partition[_co_v - 1] != uid:
+                self.income_sg__co_vs_map.setdefault(partition[_co_v - 1], []).append(_co_v)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'in_v__income_es_idx_map = {self.in_v__income_es_idx_map}')
+            logger.debug(f'income_sg__co_vs_map = {self.income_sg__co_vs_map}')
+        self.income_sgs_num = len(self.income_sg__co_vs_map)
+        timer.lap('receive plan')
+
+        self.reset()
+        timer.lap('ranks')
+        self.timings = timer.phases
+
+    def reset(self):
+        """
+        every rank 1, e.g. to run a cached sub-graph again
+        """
+        # ranks of the turn before, and the ranks of the internal vertices computed this turn, overwritten every turn
+        self.pagerank = dict.fromkeys(chain(self.in_vs, self.co_v__outgo_es_num_map), 1)
+        self._pagerank = dict.fromkeys(self.in_vs, 0)
+
+    def compute(self, share: float = 0.0):
+        # correlated vertices keep their rank until a message updates it
+        for _in_v in self.in_vs:
+            rank = 0
+            for _co_v in self.in_v__income_es_idx_map.get(_in_v, ()):
+                rank += self.pagerank[_co_v] / self.co_v__outgo_es_num_map[_co_v]
+            self._pagerank[_in_v] = rank
+
+    def interior(self):
+        pass  # compute() computes every vertex
+
+    def outgoing(self) -> Iterator[Tuple[int, Dict[int, float]]]:
+        for _sg, _vs in self.outgo_sg__in_vs_map.items():
+            yield _sg, {_v: self._pagerank[_v] for _v in _vs}
+
+    def apply(self, update: Dict[int, float]):
+        # only read by the next compute()
+        self.pagerank.update(update)
+
+    def advance(self):
+        self.pagerank.update(self._pagerank)
+
+    def residual(self) -> float:
+        return sum(abs(self._pagerank[_in_v] - self.pagerank[_in_v]) for _in_v in self.in_vs)
+
+    def dangling_mass(self) -> float:
+        return 0.0
+
+    def result(self) -> Dict[int, float]:
+        return self.pagerank
+
+    def ranks(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: internal vertices and their ranks, the part of the result this sub-graph is responsible for
+        """
+        return np.array(self.in_vs, dtype=np.int32), np.array([self.pagerank[_in_v] for _in_v in self.in_vs],
+                                                              dtype=np.float64)
+
+
+class RankCodec(object):
+    """
+    Packs the ranks a sub-graph sends to another one into bytes, the receiver learns the vertex order from the first
+    message. A message is a RANKS_HEADER followed by the vertices as int32 (first message only), the positions in the
+    vertex order as uint32 (SPARSE only) and the values.
+    """
+
+    def __init__(self, uid: int, precision: str = 'float64', tolerance: float = 0.0):
+        """
+        :param precision: float64 or float32 values on the wire
+        :param tolerance: values whose relative change since they were last sent is at most tolerance are not sent
+        again, 0 sends every value every turn
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f'precision must be one of {tuple(PRECISIONS)}, got {precision!r}')
+        self.uid = uid
+        self.dtype = PRECISIONS[precision]
+        self.flags = SINGLE if precision == 'float32' else 0
+        self.tolerance = tolerance
+        # values last sent to every sub-graph, as the receiver knows them
+        self.sent: Dict[int, np.ndarray] = {}
+        # local index of the vertex order learned from every sub-graph
+        self.orders: Dict[int, np.ndarray] = {}
+
+    def reset(self):
+        """
+        forget what was sent and received, the next message to every sub-graph carries the vertex order again
+        """
+        self.sent.clear()
+        self.orders.clear()
+
+    def encode(self, sg: int, vertices: np.ndarray, values: np.ndarray) -> bytes:
+        values = values.astype(self.dtype)
+        last = self.sent.get(sg)
+        if last is None:
+            self.sent[sg] = values
+            return b''.join((RANKS_HEADER.pack(self.uid, self.flags | ORDER, len(values)),
+                             vertices.astype('<i4').tobytes(), values.tobytes()))
+        if self.tolerance:
+            changed = np.flatnonzero(np.abs(values - last) > self.tolerance * np.abs(last))
+            # positions and values of the changed vertices, if smaller than all the values
+            if len(changed) * (4 + self.dtype.itemsize) < len(values) * self.dtype.itemsize:
+                last[changed] = values[changed]
+                return b''.join((RANKS_HEADER.pack(self.uid, self.flags | SPARSE, len(changed)),
+                                 changed.astype('<u4').tobytes(), last[changed].tobytes()))
+        self.sent[sg] = values
+        return RANKS_HEADER.pack(self.uid, self.flags, len(values)) + values.tobytes()
+
+    def decode(self, payload: Buffer, vertices: np.ndarray) -> Tuple[int, Optional[np.ndarray], np.ndarray]:
+        """
+        :param vertices: local vertices of the receiving sub-graph, the local index of the vertices of src is kept in
+        orders[src]
+        :return: src, positions of the values in the vertex order of src (None: all the vertices in order), values
+        """
+        src, flags, count = RANKS_HEADER.unpack_from(payload)
+        offset = RANKS_HEADER.size
+        if flags & ORDER:
+            self.orders[src] = np.searchsorted(vertices, np.frombuffer(payload, '<i4', count, offset))
+            offset += 4 * count
+        positions = None
+        if flags & SPARSE:
+            positions = np.frombuffer(payload, '<u4', count, offset)
+            offset += 4 * count
+        return src, positions, np.frombuffer(payload, PRECISIONS['float32' if flags & SINGLE else 'float64'], count,
+                                             offset)
+
+
+class CsrSubgraph(object):
+    """
+    The sub-graph compiled once into arrays indexed by local vertex index. Local vertices are the internal vertices and
+    the correlated vertices of other sub-graphs, sorted by vertex. The incoming edges of internal vertices are kept as
+    CSR rows expanded into (row, column, 1 / outdegree of column) triples, np.bincount over them is the mat-vec.
+
+    A turn is split to overlap computation and communication. The sums over the incoming edges are kept per row, apart
+    for edges from internal and from correlated vertices. compute() only updates the boundary vertices, the ones sent
+    to other sub-graphs, so that they are sent first. interior() updates the other internal vertices and sums the
+    edges from internal vertices for the next turn while the messages of the other sub-graphs are on their way. apply()
+    adds the change of the ranks of a message to the sums of the edges from correlated vertices as soon as it arrives.
+
+    A shard holds these arrays for one sub-graph, so that a worker loads O(|sub-graph|) instead of the whole graph:
+    vertices: local vertices (counted from 1)
+    internal: local index of every internal vertex
+    in_offsets, in_sources: CSR rows of the incoming edges of the internal vertices, sources as local index
+    outdegrees: outdegree of every local vertex, a vertex without outgoing edge links to itself
+    send_sgs, send_offsets, send_idx: send plan, local index of the internal vertices linking to every other sub-graph
+    income_sgs: sub-graphs sending pagerank of correlated vertices every turn
+    dangling: local index of the internal vertices without outgoing edge, their incoming edges include a link to
+    themselves
+
+    Messages are packed by a RankCodec, precision and tolerance are passed on to it.
+    """
+
+    SHARD_ARRAYS = ('vertices', 'internal', 'in_offsets', 'in_sources', 'outdegrees', 'send_sgs', 'send_offsets',
+                    'send_idx', 'income_sgs', 'dangling')
+
+    def __init__(self, uid: int, vertices: np.ndarray, internal: np.ndarray, in_offsets: np.ndarray,
+                 in_sources: np.ndarray, outdegrees: np.ndarray, send_sgs: np.ndarray, send_offsets: np.ndarray,
+                 send_idx: np.ndarray, income_sgs: np.ndarray, dangling: np.ndarray, precision: str = 'float64',
+                 tolerance: float = 0.0, damping: float = 1.0, dangling_policy: str = 'self',
+                 timer: Optional[Timer] = None):
+        """
+        :param damping: 1 computes the ranks without damping
+        :param dangling_policy: one of DANGLING
+        :param timer: timer of the setup so far, the phases of this one are added to it
+        """
+        if dangling_policy not in DANGLING:
+            raise ValueError(f'dangling_policy must be one of {DANGLING}, got {dangling_policy!r}')
+        timer = timer or Timer()
+        self.uid = uid
+        self.vertices = vertices
+        self.vs = vertices.astype(np.int64) - 1  # counted from 0
+        self.in_idx = internal
+        self.in_vs = vertices[internal]
+        self.in_offsets = in_offsets
+        self.rows = np.repeat(np.arange(len(internal)), np.diff(in_offsets))
+        self.cols = in_sources
+        self.outdegrees = outdegrees
+        self.weights = 1.0 / outdegrees[in_sources]
+        self.dangling_idx = dangling
+        self.damping = damping
+        self.dangling = dangling_policy
+        if dangling_policy != 'self':
+            # no link of a vertex without outgoing edge to itself, it has no other incoming edge from itself
+            is_dangling = np.zeros(len(vertices), dtype=bool)
+            is_dangling[dangling] = True
+            rows = internal[self.rows]
+            self.weights[is_dangling[rows] & (in_sources == rows)] = 0.0
+        timer.lap('edges')
+
+        # edges from internal vertices, summed by interior() for the next turn
+        is_internal = np.zeros(len(vertices), dtype=bool)
+        is_internal[internal] = True
+        local = is_internal[in_sources]
+        self.local_rows, self.local_cols, self.local_weights = self.rows[local], in_sources[local], self.weights[local]
+        # edges from correlated vertices, grouped by column, their sums are updated by every message
+        order = np.argsort(in_sources[~local], kind='stable')
+        self.remote_rows, self.remote_weights = self.rows[~local][order], self.weights[~local][order]
+        self.remote_offsets = np.zeros(len(vertices) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(in_sources[~local], minlength=len(vertices)), out=self.remote_offsets[1:])
+        self.remote_edges = np.arange(len(self.remote_rows))
+        # (position in the message, row, weight) of the edges from the vertices of every sending sub-graph
+        self.scatter: Dict[int, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+        timer.lap('edge split')
+
+        self.send_sgs, self.send_offsets, self.send_plan = send_sgs, send_offsets, send_idx
+        self.send_idx: Dict[int, np.ndarray] = {}
+        self.send_vs: Dict[int, np.ndarray] = {}
+        for i, sg in enumerate(send_sgs.tolist()):
+            self.send_idx[sg] = send_idx[send_offsets[i]:send_offsets[i + 1]]
+            self.send_vs[sg] = vertices[self.send_idx[sg]]
+
+        # internal vertices sent to other sub-graphs, as row and as local index
+        is_sent = np.zeros(len(vertices), dtype=bool)
+        is_sent[send_idx] = True
+        self.boundary_rows = np.flatnonzero(is_sent[internal])
+        self.interior_rows = np.flatnonzero(~is_sent[internal])
+        self.boundary_idx, self.interior_idx = internal[self.boundary_rows], internal[self.interior_rows]
+        timer.lap('send plan')
+
+        self.income_sgs = income_sgs
+        self.income_sgs_num = len(income_sgs)
+        self.codec = RankCodec(uid, precision, tolerance)
+        self.reset()
+        timer.lap('ranks')
+        self.timings = timer.phases
+
+    def reset(self):
+        """
+        every rank 1, e.g. to run a cached sub-graph again
+        """
+        # ranks of the turn before and of this turn, swapped by advance()
+        self.pagerank = np.ones(len(self.vs))
+        self._pagerank = np.empty_like(self.pagerank)
+        self.local_sums = self.sums(self.local_rows, self.local_cols, self.local_weights, self.pagerank)
+        # the sums of the weights, every rank is 1
+        self.remote_sums = np.bincount(self.remote_rows, weights=self.remote_weights, minlength=len(self.in_idx))
+        self._local_sums = None
+        self.share = 0.0
+        self.codec.reset()
+        self.scatter.clear()
+
+    @classmethod
+    def from_graph(cls, graph: Graph, uid: int, **options) -> 'CsrSubgraph':
+        """
+        the arrays of the shard in time linear in the sub-graph and the number of vertices, with dense tables indexed
+        by vertex instead of sorting
+        """
+        timer = Timer()
+        nodes_num = len(graph.partition)
+        in_vs = np.flatnonzero(graph.partition == uid)  # counted from 0
+        outdegrees = np.diff(graph.offsets)
+
+        rows, co_vs = csr_rows(graph.r_offsets, graph.sources, in_vs)
+        co_vs = co_vs.astype(np.int64) - 1
+        # a vertex without outgoing edge links to itself, counted if it has incoming edges like in the dict kernel. The
+        # link ends its row, the other incoming edges move by the links of the rows before.
+        loops = ((outdegrees[in_vs] == 0) & (np.diff(graph.r_offsets)[in_vs] > 0)).astype(np.int64)
+        in_offsets = np.zeros(len(in_vs) + 1, dtype=np.int64)
+        np.cumsum(np.diff(graph.r_offsets)[in_vs] + loops, out=in_offsets[1:])
+        sources = np.empty(in_offsets[-1], dtype=np.int64)
+        sources[np.arange(len(rows)) + (np.cumsum(loops) - loops)[rows]] = co_vs
+        dangling = np.flatnonzero(loops)
+        sources[in_offsets[dangling + 1] - 1] = in_vs[dangling]
+        timer.lap('in edges')
+
+        # local index of every local vertex, the local vertices sorted by vertex
+        is_local = np.zeros(nodes_num, dtype=bool)
+        is_local[in_vs] = True
+        is_local[co_vs] = True
+        vs = np.flatnonzero(is_local)
+        local_index = np.empty(nodes_num, dtype=np.int32)
+        local_index[vs] = np.arange(len(vs), dtype=np.int32)
+        internal = local_index[in_vs]
+        # sub-graphs sending pagerank of correlated vertices every turn
+        parts = int(graph.partition.max())
+        income_sgs = np.flatnonzero(np.bincount(graph.partition[vs], minlength=parts + 1))
+        income_sgs = income_sgs[income_sgs != uid]
+        timer.lap('index')
+
+        # internal vertices linking to other sub-graphs, grouped by sub-graph: (sub-graph, row) pairs marked in a table
+        out_rows, targets = csr_rows(graph.offsets, graph.targets, in_vs)
+        sgs = graph.partition[targets.astype(np.int64) - 1]
+        foreign = sgs != uid
+        is_sent = np.zeros((parts + 1) * len(in_vs), dtype=bool)
+        is_sent[sgs[foreign].astype(np.int64) * len(in_vs) + out_rows[foreign]] = True
+        pairs = np.flatnonzero(is_sent)
+        counts = np.bincount(pairs // max(len(in_vs), 1), minlength=parts + 1)
+        send_sgs = np.flatnonzero(counts)
+        send_offsets = np.zeros(len(send_sgs) + 1, dtype=np.int64)
+        np.cumsum(counts[send_sgs], out=send_offsets[1:])
+        timer.lap('send plan')
+
+        return cls(uid, (vs + 1).astype(np.int32), internal, in_offsets, local_index[sources],
+                   np.maximum(outdegrees[vs], 1).astype(np.int32), send_sgs.astype(np.int32), send_offsets,
+                   internal[pairs % max(len(in_vs), 1)], income_sgs.astype(np.int32),
+                   internal[outdegrees[in_vs] == 0], timer=timer, **options)
+
+    @classmethod
+    def from_shard(cls, shard: Dict[str, np.ndarray], uid: int, **options) -> 'CsrSubgraph':
+        return cls(uid, *(shard[name] for name in cls.SHARD_ARRAYS), **options)
+
+    def shard(self) -> Dict[str, np.ndarray]:
+        return dict(zip(self.SHARD_ARRAYS, (self.vertices, self.in_idx, self.in_offsets, self.cols, self.outdegrees,
+                                            self.send_sgs, self.send_offsets, self.send_plan, self.income_sgs,
+                                            self.dangling_idx)))
+
+    def sums(self, rows: np.ndarray, cols: np.ndarray, weights: np.ndarray, pagerank: np.ndarray) -> np.ndarray:
+        return np.bincount(rows, weights=pagerank[cols] * weights, minlength=len(self.in_idx))
+
+    def update(self, rows: np.ndarray, idx: np.ndarray):
+        self._pagerank[idx] = (1 - self.damping) + self.damping * (self.local_sums[rows] + self.remote_sums[rows] +
+                                                                   self.share)
+
+    def compute(self, share: float = 0.0):
+        """
+        ranks of the boundary vertices
+        :param share: rank every vertex receives from the vertices without outgoing edge, with the uniform policy
+        """
+        # correlated vertices keep their rank until a message updates it, the codec may skip unchanged ones
+        np.copyto(self._pagerank, self.pagerank)
+        self.share = share
+        self.update(self.boundary_rows, self.boundary_idx)
+
+    def interior(self):
+        """
+        ranks of the other internal vertices, and the sums of the edges from internal vertices for the next turn
+        """
+        self.update(self.interior_rows, self.interior_idx)
+        self._local_sums = self.sums(self.local_rows, self.local_cols, self.local_weights, self._pagerank)
+
+    def outgoing(self) -> Iterator[Tuple[int, bytes]]:
+        for sg, idx in self.send_idx.items():
+            yield sg, self.codec.encode(sg, self.send_vs[sg], self._pagerank[idx])
+
+    def apply(self, update: Buffer):
+        src, positions, values = self.codec.decode(update, self.vertices)
+        idx = self.codec.orders[src]
+        if positions is None:
+            if src not in self.scatter:
+                self.scatter[src] = self.expand(idx)
+            scatter = self.scatter[src]
+        else:
+            idx = idx[positions]
+            scatter = self.expand(idx)
+        message_pos, rows, weights = scatter
+        change = values - self._pagerank[idx]
+        self._pagerank[idx] = values
+        self.remote_sums += np.bincount(rows, weights=change[message_pos] * weights, minlength=len(self.in_idx))
+
+    def expand(self, idx: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: position in idx, row and weight of every edge from the local vertices idx
+        """
+        message_pos, edges = csr_rows(self.remote_offsets, self.remote_edges, idx)
+        return message_pos, self.remote_rows[edges], self.remote_weights[edges]
+
+    def advance(self):
+        self.pagerank, self._pagerank = self._pagerank, self.pagerank
+        self.local_sums = self._local_sums
+
+    def residual(self) -> float:
+        """
+        :return: L1 norm of the change of the ranks of the internal vertices by the last compute()
+        """
+        return float(np.abs(self._pagerank[self.in_idx] - self.pagerank[self.in_idx]).sum())
+
+    def dangling_mass(self) -> float:
+        """
+        :return: rank of the internal vertices without outgoing edge spread over all vertices, uniform policy only
+        """
+        return float(self.pagerank[self.dangling_idx].sum()) if self.dangling == 'uniform' else 0.0
+
+    def result(self) -> Dict[int, float]:
+        return dict(zip(self.vertices.tolist(), self.pagerank.tolist()))
+
+    def ranks(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :return: internal vertices and their ranks, the part of the result this sub-graph is responsible for
+        """
+        return self.in_vs, self.pagerank[self.in_idx]
+
+
+KERNELS = ('csr', 'dict')
+
+
+def load_subgraph(kernel: str, graph: Union[Graph, Dict[str, np.ndarray]], uid: int, **options):
+    """
+    :param graph: the whole graph, or the shard of sub-graph uid
+    :param options: precision and tolerance of the messages, damping and dangling_policy of the csr kernel. The dict
+    kernel sends dicts and only computes PageRank without damping.
+    """
+    if kernel == 'csr':
+        if isinstance(graph, Graph):
+            return CsrSubgraph.from_graph(graph, uid, **options)
+        return CsrSubgraph.from_shard(graph, uid, **options)
+    if kernel == 'dict':
+        if not isinstance(graph, Graph):
+            raise ValueError('the dict kernel needs the whole graph, not a shard')
+        if options.get('damping', 1.0) != 1.0 or options.get('dangling_policy', 'self') != 'self':
+            raise ValueError('the dict kernel only computes PageRank without damping, dangling_policy self')
+        timer = Timer()
+        text_graph = graph.text_graph()
+        timer.lap('text graph')
+        return DictSubgraph(text_graph, uid, timer)
+    raise ValueError(f'kernel must be one of {KERNELS}, got {kernel!r}')
+
+
+def add(left: Tuple[float, ...], right: Tuple[float, ...]) -> Tuple[float, ...]:
+    return tuple(map(operator.add, left, right))
+
+
+def run(subgraph, sen: Callable, rec: Callable, turns: range, staleness: int = 0, threshold: float = 0.0,
+        allreduce: Optional[Callable] = None, profile: Optional[List[Dict[str, float]]] = None) -> int:
+    """
+    exchange pagerank of the boundary vertices with the other workers after each turn
+    :param staleness: turns the ranks received from another worker may lag behind. 0 is lock step (BSP), turn n
+    computes with the ranks of turn n - 1 of every worker. Otherwise a turn computes with the latest ranks received, at
+    most staleness turns older, and messages are applied as they arrive.
+    :param threshold: stop once the residual, the L1 norm of the change of all ranks in a turn divided by the number
+    of vertices, is at most threshold. 0 runs all the turns.
+    :param allreduce: allreduce of the forwarder, needed for a threshold and the uniform dangling policy. Global values
+    are reduced every staleness + 1 turns, the turns in between spread the dangling rank of the last reduction.
+    :param profile: seconds of every turn are appended to it, spent in compute (including applying messages), send
+    (packing and pickling included), wait (blocked until the messages of other workers arrive) and reduce (allreduce)
+    :return: number of turns run
+    """
+    reduce_global = threshold > 0 or subgraph.dangling == 'uniform'
+    if reduce_global and allreduce is None:
+        raise ValueError('a threshold or the uniform dangling policy needs allreduce')
+    # message buffer := {turn:[payload1,payload2],}, messages of later turns in lock step
+    msg_buff: Dict[int, List[Any]] = {}
+    # latest turn applied of every sending sub-graph
+    latest: Dict[int, int] = {}
+    share, residual = 0.0, float('inf')
+    if reduce_global:
+        nodes_num = allreduce(len(subgraph.in_vs))
+    done = 0
+    for turn in turns:
+        logger.info(f'uid {subgraph.uid} start turn {turn}!\n' + '=' * 60)
+        timer = Timer() if profile is not None else None
+        if reduce_global and done % (staleness + 1) == 0:
+            mass, residual = allreduce((subgraph.dangling_mass(), residual), add)
+            if residual / nodes_num <= threshold:
+                logger.info(f'uid {subgraph.uid} converged, residual {residual / nodes_num:.3g}')
+                break
+            share = mass / nodes_num
+            if timer is not None:
+                timer.lap('reduce')
+
+        """Calculate pagerank"""
+        subgraph.compute(share)
+        if timer is not None:
+            timer.lap('compute')
+
+        """Send pagerank"""
+        # msg_update := (turn, src, payload)
+        for _sg, payload in subgraph.outgoing():
+            sen(_sg, (turn, subgraph.uid, payload))
+        if timer is not None:
+            timer.lap('send')
+
+        # the rest of the computation needs no rank of other workers, their messages are on the way meanwhile
+        subgraph.interior()
+
+        """Receive pagerank"""
+        for msg_update in msg_buff.pop(turn, ()):
+            subgraph.apply(msg_update[2])
+            latest[msg_update[1]] = turn
+        while True:
+            # poll for every message that already arrived, then block until no sub-graph lags more than staleness
+            lagging = sum(1 for src_turn in latest.values() if src_turn >= turn - staleness) < subgraph.income_sgs_num
+            if timer is not None:
+                timer.lap('compute')
+            try:
+                msg_update: Tuple[int, int, Any] = rec() if lagging else rec(0)
+            except queue.Empty:
+                break
+            finally:
+                if timer is not None:
+                    timer.lap('wait' if lagging else 'compute')
+            if staleness == 0 and msg_update[0] > turn:
+                # msg_update is of a later turn, buffer it
+                msg_buff.setdefault(msg_update[0], []).append(msg_update)
+                continue
+
+            """Update pagerank"""
+            if msg_update[0] >= latest.get(msg_update[1], 0):
+                subgraph.apply(msg_update[2])
+                latest[msg_update[1]] = msg_update[0]
+
+        residual = subgraph.residual()
+        subgraph.advance()
+        done += 1
+        if timer is not None:
+            timer.lap('compute')
+            profile.append(timer.phases)
+    return done
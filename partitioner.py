@@ -0,0 +1,162 @@
+"""
+Partitioners of the graph into sub-graphs, one per worker, used by preprocess.py and benchmark.py.
+
+Every partitioner takes the CSR arrays of graphfile.GRAPH_ARRAYS and the number of sub-graphs, and returns the
+sub-graph (counted from 1) of every vertex:
+metis: gpmetis on the undirected graph written by preprocess.py, needs METIS installed
+fennel: streaming Fennel over the CSR arrays, built in
+ldg: streaming linear deterministic greedy over the CSR arrays, built in
+hash: a hash of the vertex, no locality at all but instant
+
+quality() reports how much a partition costs the workers, the edge cut and the communication volume of every
+sub-graph, i.e. the ranks it sends and receives and the messages it sends each turn.
+"""
+import subprocess
+from typing import Callable, Dict
+
+import numpy as np
+
+# vertices of a block of the streaming partitioners, lowered for small graphs so that a block stays a small part of
+# a sub-graph
+STREAM_BLOCK = 4096
+# maximum size of a sub-graph of the streaming partitioners, relative to an even split
+SLACK = 1.1
+# passes over the graph of the streaming partitioners at most, restreaming converges within a few
+PASSES = 8
+# exponent of the size penalty of Fennel
+GAMMA = 1.5
+# alpha of Fennel relative to the one of the paper, which overweights balance when whole blocks are scored at once
+FENNEL_ALPHA = 0.25
+
+
+def sorted_unique(values: np.ndarray) -> np.ndarray:
+    """
+    same as np.unique, which is much slower than a sort on large integer arrays in recent NumPy releases. values is
+    sorted in place.
+    """
+    values.sort()
+    keep = np.empty(len(values), dtype=bool)
+    keep[:1] = True
+    np.not_equal(values[1:], values[:-1], out=keep[1:])
+    return values[keep]
+
+
+def metis(graph: Dict[str, np.ndarray], parts: int, gpmetis: str = 'gpmetis', metis_input: str = '') -> np.ndarray:
+    """
+    :param gpmetis: path of gpmetis
+    :param metis_input: the undirected graph in the input format of METIS, written by preprocess.py
+    """
+    process = subprocess.run([gpmetis, metis_input, str(parts)], capture_output=True)
+    if process.returncode or process.stderr:
+        raise RuntimeError(f'{gpmetis} failed: {(process.stderr or process.stdout).decode().strip()}')
+    # gpmetis numbers sub-graphs from 0, reassign sub-graph index 0 to (largest index + 1)
+    with open(f'{metis_input}.part.{parts}', 'rb') as metis_partition_file:
+        partition = np.fromstring(metis_partition_file.read(), dtype=np.int32, sep=' ')
+    partition[partition == 0] = partition.max() + 1
+    return partition
+
+
+def streaming(graph: Dict[str, np.ndarray], parts: int, score: Callable, passes: int = PASSES) -> np.ndarray:
+    """
+    assign the vertices in order, block by block, each to the sub-graph of the highest score. The neighbours of a
+    vertex are counted in both directions, a block is scored at once. A vertex without assigned neighbour goes to the
+    smallest sub-graph. Every pass after the first restreams the graph, with the neighbours assigned by the previous
+    pass (Nishimura and Ugander 2013), until no vertex moves.
+    :param score: (neighbours of every vertex of the block in every sub-graph, sizes of the sub-graphs, capacity) ->
+    score of every vertex of the block for every sub-graph
+    """
+    offsets, targets, r_offsets, sources = (graph[name] for name in ('offsets', 'targets', 'r_offsets', 'sources'))
+    nodes_num = len(offsets) - 1
+    capacity = SLACK * nodes_num / parts
+    # a block overfills a sub-graph by at most nodes_num / parts / 16, less than the slack
+    block = max(1, min(STREAM_BLOCK, nodes_num // (parts * 16)))
+    # 0 until assigned
+    partition = np.zeros(nodes_num + 1, dtype=np.int32)
+    for _ in range(passes):
+        previous = partition.copy()
+        sizes = np.zeros(parts, dtype=np.int64)
+        for start in range(0, nodes_num, block):
+            stop = min(start + block, nodes_num)
+            rows = np.concatenate((np.repeat(np.arange(stop - start), np.diff(offsets[start:stop + 1])),
+                                   np.repeat(np.arange(stop - start), np.diff(r_offsets[start:stop + 1]))))
+            neighbours = np.concatenate((targets[offsets[start]:offsets[stop]],
+                                         sources[r_offsets[start]:r_offsets[stop]]))
+            counts = np.bincount(rows * (parts + 1) + partition[neighbours], minlength=(stop - start) * (parts + 1))
+            counts = counts.reshape(stop - start, parts + 1)[:, 1:]
+            scores = score(counts, sizes, capacity)
+            scores[:, sizes + block > capacity] = -np.inf
+            chosen = np.argmax(scores, axis=1)
+            chosen[counts.sum(axis=1) == 0] = np.argmin(sizes)
+            partition[start + 1:stop + 1] = chosen + 1
+            sizes += np.bincount(chosen, minlength=parts)
+        if np.array_equal(previous, partition):
+            break
+    return partition[1:]
+
+
+def fennel(graph: Dict[str, np.ndarray], parts: int, passes: int = PASSES) -> np.ndarray:
+    """
+    Fennel (Tsourakakis et al. 2014): neighbours in the sub-graph minus alpha * gamma * size ** (gamma - 1)
+    """
+    nodes_num, edges_num = len(graph['offsets']) - 1, len(graph['targets'])
+    alpha = FENNEL_ALPHA * edges_num * parts ** (GAMMA - 1) / max(nodes_num, 1) ** GAMMA
+    return streaming(graph, parts, lambda counts, sizes, capacity: counts - alpha * GAMMA * sizes ** (GAMMA - 1),
+                     passes)
+
+
+def ldg(graph: Dict[str, np.ndarray], parts: int, passes: int = PASSES) -> np.ndarray:
+    """
+    linear deterministic greedy (Stanton and Kliot 2012): neighbours in the sub-graph times its remaining capacity
+    """
+    return streaming(graph, parts, lambda counts, sizes, capacity: counts * (1 - sizes / capacity), passes)
+
+
+def hash_partition(graph: Dict[str, np.ndarray], parts: int) -> np.ndarray:
+    vertices = np.arange(1, len(graph['offsets']), dtype=np.uint64)
+    # Fibonacci hashing, the high bits of the product are spread evenly
+    return ((vertices * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)) % np.uint64(parts) + 1
+
+
+PARTITIONERS: Dict[str, Callable[..., np.ndarray]] = {'metis': metis, 'fennel': fennel, 'ldg': ldg,
+                                                      'hash': hash_partition}
+
+
+def partition_graph(method: str, graph: Dict[str, np.ndarray], parts: int, **options) -> np.ndarray:
+    """
+    :param method: one of PARTITIONERS
+    :param options: keyword arguments of the partitioner, gpmetis and metis_input of metis, passes of fennel and ldg
+    :return: sub-graph of every vertex, counted from 1
+    """
+    return PARTITIONERS[method](graph, parts, **options).astype(np.int32)
+
+
+def quality(graph: Dict[str, np.ndarray], partition: np.ndarray) -> Dict:
+    """
+    a worker sends the rank of each of its vertices once to every other sub-graph the vertex links to, in one message
+    per sub-graph, like the send plan of pagerank.CsrSubgraph
+    :return: edge cut, and per sub-graph: vertices, ranks sent and received, messages sent each turn
+    """
+    offsets, targets = graph['offsets'], graph['targets']
+    parts = int(partition.max())
+    sources = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    source_sgs = partition[sources].astype(np.int64)
+    target_sgs = partition[targets.astype(np.int64) - 1].astype(np.int64)
+    cut = source_sgs != target_sgs
+    # (vertex, sub-graph) pairs and (sub-graph, sub-graph) pairs of the cut edges
+    sends = sorted_unique(sources[cut] * (parts + 1) + target_sgs[cut])
+    links = sorted_unique(source_sgs[cut] * (parts + 1) + target_sgs[cut])
+    return {'vertices': len(partition), 'edges': len(targets), 'parts': parts, 'edge cut': int(cut.sum()),
+            'sizes': np.bincount(partition, minlength=parts + 1)[1:].tolist(),
+            'sent': np.bincount(partition[sends // (parts + 1)], minlength=parts + 1)[1:].tolist(),
+            'received': np.bincount(sends % (parts + 1), minlength=parts + 1)[1:].tolist(),
+            'messages': np.bincount(links // (parts + 1), minlength=parts + 1)[1:].tolist()}
+
+
+def summary(report: Dict) -> str:
+    """
+    one line of a report of quality()
+    """
+    return (f'edge cut {report["edge cut"]} ({report["edge cut"] / max(report["edges"], 1):.1%}), '
+            f'largest sub-graph {max(report["sizes"]) / (report["vertices"] / report["parts"]):.2f} of even, '
+            f'ranks sent per turn {sum(report["sent"])} (max {max(report["sent"])} per worker), '
+            f'messages per turn {sum(report["messages"])}')
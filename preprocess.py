@@ -1,13 +1,23 @@
-import io
+import argparse
+import hashlib
+import json
 import logging
 import os
+import shutil
 import subprocess
-import sys
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Sequence, Tuple
 
 import boto3
+import numpy as np
 from botocore.exceptions import ClientError
 
+import graphfile
+import local
+import pagerank
+import partitioner
+
 FORMAT = f"%(filename)-13s|%(funcName)-10s|%(lineno)-3d|%(message)s"
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
@@ -15,176 +25,410 @@ logger.setLevel(logging.INFO)
 
 """
 This script is used to preprocess raw data set, modify it if it can not parse raw data set correctly. 
-It is requested to run on a machine pre-installed metis(gpmetis), and python3.6+
+It is requested to run on a machine pre-installed metis(gpmetis), unless another partitioner is chosen, and python3.6+
 """
 
 start_time = time.time()
 
+# bytes of the raw files parsed at once
+CHUNK_SIZE = 16 * 2 ** 20
+# lines of the output files formatted at once
+WRITE_BLOCK = 65536
+# bump to invalidate cached artifacts when the format of preprocessing results changes
+CACHE_VERSION = 2
+# S3 object metadata holding the content hash of an uploaded file
+DIGEST_METADATA = 'content-digest'
+
 
 def shell_command(command: str = 'ls'):
     process = subprocess.run([command], capture_output=True, shell=True)
     return process.stdout, process.stderr
 
 
-def upload_file(file_name, bucket, object_name=None):
-    """Upload a file to an S3 bucket
+def file_digest(*paths: str) -> str:
+    """
+    content hash of the files, in the given order
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(CHUNK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def upload_file(file_name, bucket, object_name=None, s3_client=None):
+    """Upload a file to an S3 bucket, unless the object already has the same content
 
     :param file_name: File to upload
     :param bucket: Bucket to upload to
     :param object_name: S3 object name. If not specified then file_name is used
-    :return: True if file was uploaded, else False
+    :param s3_client: S3 client, or a local.LocalStore. If not specified then a new S3 client is used
+    :return: True if file was uploaded or up to date, else False
     """
 
     # If S3 object_name was not specified, use file_name
     if object_name is None:
         object_name = file_name
 
+    # the content hash is kept in the metadata of the object, ETags of multipart uploads are no content hash
+    s3_client = s3_client or boto3.client('s3')
+    digest = file_digest(file_name)
+    try:
+        if s3_client.head_object(Bucket=bucket, Key=object_name)['Metadata'].get(DIGEST_METADATA) == digest:
+            logger.info(f'{object_name} is up to date')
+            return True
+    except ClientError:
+        pass  # no such object yet
+
     # Upload the file
-    s3_client = boto3.client('s3')
     try:
-        response = s3_client.upload_file(file_name, bucket, object_name)
+        response = s3_client.upload_file(file_name, bucket, object_name,
+                                         ExtraArgs={'Metadata': {DIGEST_METADATA: digest}})
     except ClientError as e:
         logger.error(e)
         return False
     return True
 
 
-PEERS_NUM = 20 if len(sys.argv) == 1 else int(sys.argv[1])
-print(f'PEERS_NUM = {PEERS_NUM}')
-
-"""input"""
-# delimiter = ' '
-delimiter = '\t'
-# input_files_fold = './facebook/'
-input_files_fold = './'
-# all_input_files_name = [path for path in os.listdir(input_files_fold) if path.endswith('.edges')]
-all_input_files_name = ('soc-pokec-relationships.txt',)
-print(f'input files: {all_input_files_name}')
-
-"""output"""
-tmp_undirected_graph = './tmp_metis'
-tmp_metis_result = f'{tmp_undirected_graph}.part.{PEERS_NUM}'
-result_dataset = 'soc-pokec_dataset'
-result_r_dataset = f'r_{result_dataset}'
-result_partition = f'{result_dataset}_partition_{PEERS_NUM}'
-
-"""upload"""
-bucket = 'pagerankdataset'
-s3_key_dataset = result_dataset
-s3_key_r_dataset = result_r_dataset
-s3_key_partition = result_partition
-
-"""start pre-process"""
-
-all_raw_files_path = [os.path.join(input_files_fold, path) for path in all_input_files_name]
-if os.path.isfile(tmp_metis_result):
-    os.remove(tmp_metis_result)
-    print(f'remove old "{tmp_metis_result}"')
-if os.path.isfile(tmp_undirected_graph):
-    os.remove(tmp_undirected_graph)
-    print(f'remove old "{tmp_undirected_graph}"')
-
-# aggregate all the contents from all raw files
-contents = []
-for file_path in all_raw_files_path:
-    with open(file_path, 'r') as raw_file:
-        contents += raw_file.readlines()
-
-# find all the nodes
-exist_nodes = set()
-try:
-    for line in contents:
-        a, b = line.split(delimiter)
-        exist_nodes.add(int(a))
-        exist_nodes.add(int(b))
-except Exception as e:
-    print(line)
-    raise e
-
-# reassign continuous index for each node
-node_mapping = dict(zip(exist_nodes, range(1, len(exist_nodes) + 1)))
-
-matrix = [[] for _ in range(len(exist_nodes))]
-r_matrix = [[] for _ in range(len(exist_nodes))]
-tmp_matrix = [set() for _ in range(len(exist_nodes))]
-# reformat raw data set to the format fit for metis
-undirected_edges = set()
-for line in contents:
-    a, b = line.split(delimiter)
-    a = node_mapping[int(a)]
-    b = node_mapping[int(b)]
-    matrix[a - 1].append(b)
-    r_matrix[b - 1].append(a)
-    # make relation undirected
-    tmp_matrix[a - 1].add(b)
-    undirected_edges.add((a, b))
-    tmp_matrix[b - 1].add(a)
-    undirected_edges.add((b, a))
-
-# to fit input of distributed page rank
-buffer = io.StringIO()
-for edges in matrix:
-    buffer.write(' '.join(map(str, edges)))
-    buffer.write('\n')
-
-with open(result_dataset, 'w') as data_set:
-    data_set.write(buffer.getvalue())
-buffer.close()
-
-buffer = io.StringIO()
-for edges in r_matrix:
-    buffer.write(' '.join(map(str, edges)))
-    buffer.write('\n')
-
-with open(result_r_dataset, 'w') as data_set:
-    data_set.write(buffer.getvalue())
-buffer.close()
-
-# to fit input format of metis
-buffer = io.StringIO()
-buffer.write(f'{len(exist_nodes)} {len(undirected_edges) // 2}\n')
-for edges in tmp_matrix:
-    buffer.write(' '.join(map(str, edges)))
-    buffer.write('\n')
-
-with open(tmp_undirected_graph, 'w') as data_set_for_metis:
-    data_set_for_metis.write(buffer.getvalue())
-buffer.close()
-
-# call metis to partition graph
-stdout, stderr = shell_command('sudo find  /  -iname gpmetis')
-metis_path = stdout.decode().strip()
-print(f'{metis_path} {tmp_undirected_graph} {PEERS_NUM}')
-stdout, stderr = shell_command(f'{metis_path} {tmp_undirected_graph} {PEERS_NUM}')
-
-if stderr:
-    for line in stderr.decode().split('\n'):
-        print(line)
-    exit(-1)
-
-for line in stdout.decode().split('\n'):
-    print(line)
-
-print(f'wait for {tmp_metis_result}')
-while not os.path.isfile(tmp_metis_result):
-    time.sleep(1)
-print(f'{tmp_metis_result} is ready')
-
-# reformat partition file to the format fit for distributed page rank, reassign subgruph index 0 to (largest index + 1)
-with open(tmp_metis_result, 'r') as metis_partition_file:
-    partitions = tuple(int(partition) for partition in metis_partition_file.readlines())
-    max_subgraph = max(partitions) + 1
-    partitions = (str(partition if partition != 0 else max_subgraph) for partition in partitions)
-
-buffer = '\n'.join(partitions)
-with open(result_partition, 'w') as result_partition_file:
-    result_partition_file.write(buffer)
-print(f'time consumption {time.time() - start_time}s')
-
-# upload files to S3
-upload_file(result_dataset, bucket, s3_key_dataset)
-print(f'upload {result_dataset} to S3 bucket {bucket}, key = {s3_key_dataset}')
-upload_file(result_r_dataset, bucket, s3_key_r_dataset)
-print(f'upload {result_r_dataset} to S3 bucket {bucket}, key = {s3_key_r_dataset}')
-upload_file(result_partition, bucket, s3_key_partition)
-print(f'upload {result_partition} to S3 bucket {bucket}, key = {s3_key_partition}')
+def find_gpmetis(cache_file: str) -> str:
+    """
+    path of gpmetis, searched for once and remembered in cache_file
+    """
+    if os.path.isfile(cache_file):
+        with open(cache_file) as file:
+            metis_path = file.read().strip()
+        if os.path.isfile(metis_path):
+            return metis_path
+    metis_path = shutil.which('gpmetis')
+    if metis_path is None:
+        stdout, stderr = shell_command('sudo find  /  -iname gpmetis')
+        metis_path = stdout.decode().split('\n')[0].strip()
+    if metis_path:
+        with open(cache_file, 'w') as file:
+            file.write(metis_path)
+    return metis_path
+
+
+def commit(*paths: str):
+    """
+    files are written to <path>.tmp and renamed once complete, so that an interrupted run leaves no partial file
+    in the cache
+    """
+    for path in paths:
+        os.replace(f'{path}.tmp', path)
+
+
+def split_file(path: str, parts: int) -> List[Tuple[str, int, int]]:
+    """
+    :return: (path, start, end) of up to parts byte ranges of the file, every range starts at the beginning of a line
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, 'rb') as raw_file:
+        for i in range(1, parts):
+            raw_file.seek(max(size * i // parts, bounds[-1]))
+            raw_file.readline()
+            bounds.append(min(raw_file.tell(), size))
+    bounds.append(size)
+    return [(path, start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_edges(path: str, delimiter: str, start: int = 0, end: Optional[int] = None) -> np.ndarray:
+    """
+    parse an edge list in chunks of CHUNK_SIZE bytes, without a Python object per line or number
+    :param start, end: byte range of the file, starting at the beginning of a line
+    :return: (number of edges, 2) array of raw node ids
+    """
+    chunks = []
+    rest = b''
+    with open(path, 'rb') as raw_file:
+        raw_file.seek(start)
+        remaining = (os.path.getsize(path) if end is None else end) - start
+        while remaining > 0:
+            block = raw_file.read(min(CHUNK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            block = rest + block
+            end = block.rfind(b'\n') + 1
+            rest = block[end:]
+            chunks.append(np.fromstring(block[:end], dtype=np.int64, sep=delimiter))
+    chunks.append(np.fromstring(rest, dtype=np.int64, sep=delimiter))
+    values = np.concatenate(chunks)
+    if len(values) % 2:
+        raise ValueError(f'{path} is not a list of edges')
+    return values.reshape(-1, 2)
+
+
+def stable_argsort(keys: np.ndarray) -> np.ndarray:
+    """
+    same as np.argsort(keys, kind='stable') for non-negative keys. Key and position are packed into one int64 if they
+    fit, sorting those is several times faster than an argsort.
+    """
+    if len(keys) == 0 or int(keys.max()) >= 2 ** 62 // len(keys):
+        return np.argsort(keys, kind='stable')
+    packed = keys.astype(np.int64)
+    packed *= len(keys)
+    packed += np.arange(len(keys))
+    packed.sort()
+    packed %= len(keys)
+    return packed
+
+
+def remap(values: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: sorted distinct values, values replaced by their index in the distinct values counted from 1
+    """
+    flat = values.ravel()
+    order = stable_argsort(flat)
+    ordered = flat[order]
+    new = np.empty(len(flat), dtype=bool)
+    new[:1] = True
+    np.not_equal(ordered[1:], ordered[:-1], out=new[1:])
+    index = np.empty(len(flat), dtype=np.int32)
+    index[order] = np.cumsum(new, dtype=np.int32)
+    return ordered[new], index.reshape(values.shape)
+
+
+def parse_range(task: Tuple[str, int, int], delimiter: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    runs in the process pool, parses a byte range of a raw file and numbers its nodes
+    :return: sorted distinct raw node ids of the range, edges as index into them counted from 1
+    """
+    path, start, end = task
+    return remap(read_edges(path, delimiter, start, end))
+
+
+def merge_ranges(ranges: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[int, np.ndarray]:
+    """
+    :param ranges: results of parse_range
+    :return: number of nodes, edges with a continuous index counted from 1 for each node, in the order of the raw ids
+    """
+    exist_nodes = partitioner.sorted_unique(np.concatenate([nodes for nodes, _ in ranges]))
+    edges = np.empty((sum(len(range_edges) for _, range_edges in ranges), 2), dtype=np.int32)
+    offset = 0
+    for nodes, range_edges in ranges:
+        mapping = np.zeros(len(nodes) + 1, dtype=np.int32)
+        mapping[1:] = np.searchsorted(exist_nodes, nodes) + 1
+        edges[offset:offset + len(range_edges)] = mapping[range_edges]
+        offset += len(range_edges)
+    return len(exist_nodes), edges
+
+
+def csr(keys: np.ndarray, values: np.ndarray, nodes_num: int):
+    """
+    :param keys: vertex (counted from 1) of every value
+    :return: offsets and values grouped by key, in input order within a key, the CSR arrays of graphfile.py
+    """
+    offsets = np.zeros(nodes_num + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=nodes_num + 1)[1:], out=offsets[1:])
+    return offsets, values[stable_argsort(keys)]
+
+
+def undirected_csr(edges: np.ndarray, nodes_num: int):
+    """
+    the graph made undirected for metis, every edge once per direction and no self loop
+    :return: offsets and neighbours, the CSR arrays of the undirected graph
+    """
+    a, b = edges[:, 0], edges[:, 1]
+    a, b = a[a != b], b[a != b]
+    # (u, v) encoded as u * (nodes_num + 1) + v, sorted by u and without duplicates, built in place
+    keys = np.empty(2 * len(a), dtype=np.int64)
+    for half, (u, v) in enumerate(((a, b), (b, a))):
+        keys[half * len(a):(half + 1) * len(a)] = u
+        keys[half * len(a):(half + 1) * len(a)] *= nodes_num + 1
+        keys[half * len(a):(half + 1) * len(a)] += v
+    del a, b
+    keys = partitioner.sorted_unique(keys)
+    heads, neighbours = np.divmod(keys, nodes_num + 1)
+    offsets = np.zeros(nodes_num + 1, dtype=np.int64)
+    np.cumsum(np.bincount(heads, minlength=nodes_num + 1)[1:], out=offsets[1:])
+    return offsets, neighbours.astype(np.int32)
+
+
+def write_lines(path: str, offsets: np.ndarray, values: np.ndarray, header: str = ''):
+    """
+    write one line per vertex, its values separated by spaces, WRITE_BLOCK lines at a time
+    """
+    with open(path, 'w') as file:
+        file.write(header)
+        for start in range(0, len(offsets) - 1, WRITE_BLOCK):
+            stop = min(start + WRITE_BLOCK, len(offsets) - 1)
+            block = values[offsets[start]:offsets[stop]].tolist()
+            bounds = (offsets[start:stop + 1] - offsets[start]).tolist()
+            file.write(''.join(' '.join(map(str, block[bounds[i]:bounds[i + 1]])) + '\n' for i in range(stop - start)))
+
+
+def write_metis(path: str, offsets: np.ndarray, targets: np.ndarray):
+    nodes_num = len(offsets) - 1
+    edges = np.stack((np.repeat(np.arange(1, nodes_num + 1, dtype=np.int32), np.diff(offsets)), targets), axis=1)
+    undirected_offsets, neighbours = undirected_csr(edges, nodes_num)
+    del edges
+    write_lines(path, undirected_offsets, neighbours, f'{nodes_num} {len(neighbours) // 2}\n')
+
+
+def write_shards(path: str, graph_path: str, partition_path: str, uids: Sequence[int]):
+    """
+    everything a worker needs of the graph, so that it does not have to download the whole graph. The graph and the
+    partition are mapped from their containers rather than pickled into every task.
+    """
+    graph_arrays = graphfile.load(graph_path)
+    graph = pagerank.Graph(*(graph_arrays[name] for name in graphfile.GRAPH_ARRAYS),
+                           graphfile.load(partition_path)['partition'])
+    for uid in uids:
+        graphfile.write(f'{path}_{uid}.tmp', pagerank.CsrSubgraph.from_graph(graph, uid).shard())
+        commit(f'{path}_{uid}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('peers', type=int, nargs='*', default=[20],
+                        help='numbers of sub-graphs (PEERS_NUM), the graph is parsed once for all of them')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='processes parsing the raw files and writing the output files')
+    parser.add_argument('--cache', default='./preprocess_cache',
+                        help='directory of the results, reused as long as the raw files do not change')
+    parser.add_argument('--partitioner', choices=partitioner.PARTITIONERS, default='metis',
+                        help='gpmetis, the built-in streaming partitioners fennel or ldg, or hash partitioning')
+    parser.add_argument('--gpmetis', help='path of gpmetis, searched for once and cached if omitted')
+    parser.add_argument('--store', metavar='DIR', help='upload to DIR standing in for S3, see local.py')
+    args = parser.parse_args()
+    print(f'PEERS_NUM = {args.peers}, workers = {args.workers}, partitioner = {args.partitioner}')
+
+    """input"""
+    # delimiter = ' '
+    delimiter = '\t'
+    # input_files_fold = './facebook/'
+    input_files_fold = './'
+    # all_input_files_name = [path for path in os.listdir(input_files_fold) if path.endswith('.edges')]
+    all_input_files_name = ('soc-pokec-relationships.txt',)
+    print(f'input files: {all_input_files_name}')
+
+    """output"""
+    # binary: containers of graphfile.py loaded by client.py without parsing, r_dataset is part of the dataset container
+    # text: space separated text, one line per vertex
+    output_format = 'binary'
+    # output_format = 'text'
+    result_dataset = 'soc-pokec_dataset'
+
+    """upload"""
+    bucket = 'pagerankdataset'
+
+    """start pre-process"""
+
+    all_raw_files_path = [os.path.join(input_files_fold, path) for path in all_input_files_name]
+    os.makedirs(args.cache, exist_ok=True)
+    # results derived from the graph are cached under the content hash of the raw files
+    graph_hash = file_digest(*all_raw_files_path)
+    graph_hash = hashlib.blake2b(f'{graph_hash} {delimiter!r} {CACHE_VERSION}'.encode(), digest_size=16).hexdigest()
+    graph_dir = os.path.join(args.cache, graph_hash)
+    os.makedirs(graph_dir, exist_ok=True)
+    print(f'cache directory {graph_dir}')
+    graph_path = os.path.join(graph_dir, 'graph')
+    tmp_undirected_graph = os.path.join(graph_dir, 'metis')
+    text_dataset = os.path.join(graph_dir, 'dataset')
+    text_r_dataset = os.path.join(graph_dir, 'r_dataset')
+
+    executor = ProcessPoolExecutor(args.workers)
+    # writes the graph container, a thread shares the arrays that a worker process would get a pickled copy of
+    writer = ThreadPoolExecutor(1)
+
+    # the graph and the files derived from it are written in parallel, and renamed once all of them are complete
+    futures = []
+    written: List[str] = []
+    if os.path.isfile(graph_path):
+        print(f'graph {graph_hash} is cached')
+        graph_arrays = graphfile.load(graph_path)
+    else:
+        # parse all the raw files, every file is split into byte ranges parsed in parallel
+        tasks = [task for file_path in all_raw_files_path for task in split_file(file_path, args.workers)]
+        # reassign continuous index for each node, in the order of the raw ids
+        nodes_num, edges = merge_ranges(list(executor.map(parse_range, tasks, [delimiter] * len(tasks))))
+
+        # to fit input of distributed page rank
+        offsets, targets = csr(edges[:, 0], edges[:, 1], nodes_num)
+        r_offsets, sources = csr(edges[:, 1], edges[:, 0], nodes_num)
+        graph_arrays = {'offsets': offsets, 'targets': targets, 'r_offsets': r_offsets, 'sources': sources}
+        del edges
+        futures.append(writer.submit(graphfile.write, f'{graph_path}.tmp', graph_arrays))
+        written.append(graph_path)
+
+    if output_format == 'text' and not (os.path.isfile(text_dataset) and os.path.isfile(text_r_dataset)):
+        futures.append(executor.submit(write_lines, f'{text_dataset}.tmp', graph_arrays['offsets'],
+                                       graph_arrays['targets']))
+        futures.append(executor.submit(write_lines, f'{text_r_dataset}.tmp', graph_arrays['r_offsets'],
+                                       graph_arrays['sources']))
+        written.extend((text_dataset, text_r_dataset))
+
+    options = {}
+    if args.partitioner == 'metis':
+        if not os.path.isfile(tmp_undirected_graph):
+            futures.append(executor.submit(write_metis, f'{tmp_undirected_graph}.tmp', graph_arrays['offsets'],
+                                           graph_arrays['targets']))
+            written.append(tmp_undirected_graph)
+        options = {'gpmetis': args.gpmetis or find_gpmetis(os.path.join(args.cache, 'gpmetis_path')),
+                   'metis_input': tmp_undirected_graph}
+    for future in futures:
+        future.result()
+    commit(*written)
+    writer.shutdown()
+    uploads = [(graph_path, result_dataset)] if output_format == 'binary' else \
+        [(text_dataset, result_dataset), (text_r_dataset, f'r_{result_dataset}')]
+
+    for PEERS_NUM in args.peers:
+        # partitions are cached under (graph hash, partitioner, PEERS_NUM)
+        partition_path = os.path.join(graph_dir, f'partition_{args.partitioner}_{PEERS_NUM}')
+        text_partition = f'{partition_path}.txt'
+        report_path = f'{partition_path}.json'
+        shard_path = os.path.join(graph_dir, f'shard_{args.partitioner}_{PEERS_NUM}')
+        result_partition = f'{result_dataset}_partition_{PEERS_NUM}'
+        # one shard per sub-graph, <result_shard>_<uid>, only written in binary output format
+        result_shard = f'{result_dataset}_shard_{PEERS_NUM}'
+
+        if os.path.isfile(partition_path) and os.path.isfile(report_path):
+            print(f'partition into {PEERS_NUM} sub-graphs is cached')
+            partition = graphfile.load(partition_path)['partition']
+            with open(report_path) as report_file:
+                report = json.load(report_file)
+        else:
+            partition_start = time.time()
+            try:
+                partition = partitioner.partition_graph(args.partitioner, graph_arrays, PEERS_NUM, **options)
+            except RuntimeError as e:
+                print(e)
+                exit(-1)
+            report = partitioner.quality(graph_arrays, partition)
+            report['seconds'] = time.time() - partition_start
+            graphfile.write(f'{partition_path}.tmp', {'partition': partition})
+            with open(f'{report_path}.tmp', 'w') as report_file:
+                json.dump(report, report_file)
+            commit(partition_path, report_path)
+        print(f'{args.partitioner} into {PEERS_NUM} sub-graphs in {report["seconds"]:.2f}s: '
+              f'{partitioner.summary(report)}')
+        for uid in range(1, PEERS_NUM + 1):
+            logger.info(f'sub-graph {uid}: {report["sizes"][uid - 1]} vertices, sends {report["sent"][uid - 1]} ranks '
+                        f'in {report["messages"][uid - 1]} messages, receives {report["received"][uid - 1]} ranks')
+
+        if output_format == 'binary':
+            uids = [uid for uid in range(1, PEERS_NUM + 1) if not os.path.isfile(f'{shard_path}_{uid}')]
+            if uids:
+                for future in [executor.submit(write_shards, shard_path, graph_path, partition_path,
+                                               uids[i::args.workers]) for i in range(min(args.workers, len(uids)))]:
+                    future.result()
+            uploads.append((partition_path, result_partition))
+            uploads.extend((f'{shard_path}_{uid}', f'{result_shard}_{uid}') for uid in range(1, PEERS_NUM + 1))
+        else:
+            if not os.path.isfile(text_partition):
+                with open(f'{text_partition}.tmp', 'w') as result_partition_file:
+                    result_partition_file.write('\n'.join(map(str, partition.tolist())))
+                commit(text_partition)
+            uploads.append((text_partition, result_partition))
+    executor.shutdown()
+    print(f'time consumption {time.time() - start_time}s')
+
+    # upload files to S3, objects with the same content are skipped
+    s3_client = local.LocalStore(args.store) if args.store else boto3.client('s3')
+    for file_name, key in uploads:
+        if upload_file(file_name, bucket, key, s3_client):
+            print(f'upload {file_name} to S3 bucket {bucket}, key = {key}')
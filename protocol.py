@@ -0,0 +1,93 @@
+"""
+Wire format shared by server.py and softwareforwarder.py, it has to be deployed together with both of them.
+
+A batch is a plain concatenation of entries, every entry is a fixed header followed by an optional destination puid
+and the message payload. Payloads are opaque to the server (a MESSAGE_HEADER followed by a pickle), it never decodes
+them to route a batch. The channel of the MESSAGE_HEADER keeps messages of collective operations apart from the ones
+of the user function on the receiving peer.
+
+Peers talking directly over TCP exchange a stream of length prefixed payload frames, the receiving peer acknowledges
+every frame with the sequence number of its message.
+
+A sharded server spreads the mailboxes over several processes, the shard owning the mailbox of a puid is found by
+consistent hashing, by peers and shards alike.
+"""
+import bisect
+import hashlib
+import struct
+from typing import Iterable, Iterator, Optional, Sequence, Tuple
+
+OCTET_STREAM = 'application/octet-stream'
+
+# length of destination puid, length of payload
+ENTRY_HEADER = struct.Struct('!HI')
+# length of payload, frames of the direct peer to peer stream
+FRAME_HEADER = struct.Struct('!I')
+# uid of the sending peer, its sequence number of the message and the channel, prefix of every payload
+MESSAGE_HEADER = struct.Struct('!IQB')
+# messages passed to sen() and returned by rec()
+USER_CHANNEL = 0
+# messages of collective operations, never returned by rec()
+COLLECTIVE_CHANNEL = 1
+# sequence number of a message received over a direct connection, written back by the receiving peer
+ACK_HEADER = struct.Struct('!Q')
+
+
+def pack_batch(entries: Iterable[Tuple[Optional[str], bytes]]) -> bytes:
+    """
+    :param entries: (dst, payload) pairs, dst can be None when the batch is sent to a known receiver
+    """
+    chunks = []
+    for dst, payload in entries:
+        dst = b'' if dst is None else dst.encode('ascii')
+        chunks.append(ENTRY_HEADER.pack(len(dst), len(payload)))
+        chunks.append(dst)
+        chunks.append(payload)
+    return b''.join(chunks)
+
+
+def unpack_batch(data: bytes) -> Iterator[Tuple[Optional[str], bytes]]:
+    view = memoryview(data)
+    offset = 0
+    while offset < len(view):
+        dst_len, payload_len = ENTRY_HEADER.unpack_from(view, offset)
+        offset += ENTRY_HEADER.size
+        dst = bytes(view[offset:offset + dst_len]).decode('ascii') if dst_len else None
+        offset += dst_len
+        yield dst, bytes(view[offset:offset + payload_len])
+        offset += payload_len
+
+
+def pack_frames(payloads: Iterable[bytes]) -> bytes:
+    return b''.join(FRAME_HEADER.pack(len(payload)) + payload for payload in payloads)
+
+
+def read_frame(stream) -> Optional[bytes]:
+    """
+    :param stream: binary file object, e.g. socket.makefile('rb')
+    :return: payload of the next frame, None once the stream is closed
+    """
+    header = stream.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        return None
+    payload_len, = FRAME_HEADER.unpack(header)
+    payload = stream.read(payload_len)
+    return payload if len(payload) == payload_len else None
+
+
+def hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """
+    consistent hashing of puids onto shards, every shard is placed on the ring at vnodes points to even out the load
+    """
+
+    def __init__(self, shards: Sequence[str], vnodes: int = 64):
+        points = sorted((hash_key(f'{shard}#{i}'), shard) for shard in shards for i in range(vnodes))
+        self.keys = [key for key, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    def owner(self, puid: str) -> str:
+        return self.shards[bisect.bisect(self.keys, hash_key(puid)) % len(self.keys)]
@@ -1,36 +1,63 @@
+import argparse
 import asyncio
+import base64
+import collections
 import logging
+import time
+import urllib.error
+import urllib.request
 import uuid
-from typing import Optional
+from typing import Optional, Iterable, Tuple, Dict, List, Deque
 
 import uvicorn
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import RedirectResponse
 from pydantic import BaseModel
 
+from protocol import OCTET_STREAM, HashRing, pack_batch, unpack_batch
+
 FORMAT = f"%(filename)-13s|%(funcName)-10s|%(lineno)-3d|%(message)s"
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-PEERS_NUM = 80
+# size of a job registering without size, same default as invoker.py
+PEERS_NUM = 100
 logger.info(f'PEERS_NUM = {PEERS_NUM}')
-peers = {}  # {puid:peer}
+peers = {}  # {puid:peer}, registered peers, only kept by the first shard
+jobs = {}  # {name:job}, jobs still waiting for peers to register
+completions = {}  # {name:completions}, summaries of the instances of a job that are done, only kept by the first shard
+mailboxes = {}  # {puid:mailbox}, mailboxes owned by this shard
+# limits of every mailbox, a message that does not fit waits up to BACKPRESSURE_TIMEOUT seconds for room, then it is
+# refused with 429. An empty mailbox accepts any message, however large.
+MAILBOX_MAX_MESSAGES = 10000
+MAILBOX_MAX_BYTES = 64 * 2 ** 20
+BACKPRESSURE_TIMEOUT = 1.0
+RETRY_AFTER = 1  # seconds, Retry-After of 429 responses
+# count the messages and bytes of every mailbox and the seconds messages wait in it, served by /metrics/
+METRICS = True
+# base urls of all shards when the server is sharded, the first one takes registrations
+SHARDS: Tuple[str, ...] = ()
+SHARD_INDEX = 0
+ring: Optional[HashRing] = None
 
 app = FastAPI()
 
 
 class Data(BaseModel):
+    """JSON envelope of the compatibility transport, payload is a base64 encoded pickle"""
     payload: Optional[bytes] = None
 
 
 class Peer(object):
     uid_pool = list(range(1000, 0, -1))
 
-    def __init__(self, ip, port, uid=None):
+    def __init__(self, ip, port, uid=None, direct=False, job=None):
         self.puid: str = uuid.uuid4().hex if uid is None else uid
         self.ip = ip
         self.port = port
-        self.msgs_q = asyncio.Queue()
+        self.direct = direct  # whether ip:port accepts direct peer to peer connections
+        self.job: Optional['Job'] = job
 
     def __str__(self):
         return f'Peer object: puid = {self.puid}, {self.ip}:{self.port}'
@@ -38,44 +65,545 @@ class Peer(object):
     __repr__ = __str__
 
 
+class Barrier(object):
+    """
+    reusable barrier of asyncio tasks, every generation is released by its own event
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.arrived = 0
+        self.released = asyncio.Event()
+
+    async def wait(self):
+        released = self.released
+        self.arrived += 1
+        if self.arrived == self.size:
+            self.arrived = 0
+            self.released = asyncio.Event()
+            released.set()
+        else:
+            await released.wait()
+
+
+class Job(object):
+    """
+    group of peers running together, registration returns once size peers have registered
+    """
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+        self.peers: Dict[str, Peer] = {}  # {puid:peer}, in registration order
+        self.preferred: Dict[str, int] = {}  # {puid:uid} asked for at registration
+        self.members: Tuple[Peer, ...] = ()  # peers of the job, fixed once all of them have registered
+        self.complete = asyncio.Event()
+        self.barriers: Dict[str, Barrier] = {}
+
+    def add(self, peer: Peer, uid: Optional[int] = None):
+        self.peers[peer.puid] = peer
+        if uid is not None:
+            self.preferred[peer.puid] = uid
+        if len(self.peers) == self.size:
+            self.members = self.order()
+            self.complete.set()
+
+    def order(self) -> Tuple[Peer, ...]:
+        """
+        a peer gets the uid (position counted from 1) it asked for unless a peer registered before got it, the other
+        peers fill the rest in registration order
+        """
+        members: List[Optional[Peer]] = [None] * self.size
+        rest = []
+        for puid, peer in self.peers.items():
+            uid = self.preferred.get(puid)
+            if uid is not None and 1 <= uid <= self.size and members[uid - 1] is None:
+                members[uid - 1] = peer
+            else:
+                rest.append(peer)
+        unplaced = iter(rest)
+        return tuple(peer if peer is not None else next(unplaced) for peer in members)
+
+    def barrier(self, name: str) -> Barrier:
+        if name not in self.barriers:
+            self.barriers[name] = Barrier(self.size)
+        return self.barriers[name]
+
+
+class Completions(object):
+    """
+    summaries the instances of a job post once they are done, e.g. for invoker.py that invoked them asynchronously
+    """
+
+    def __init__(self):
+        self.summaries: List[dict] = []
+        self.changed = asyncio.Event()
+
+    def add(self, summary: dict):
+        self.summaries.append(summary)
+        self.changed.set()
+
+    async def wait(self, size: int, timeout: Optional[float]) -> bool:
+        """
+        :return: whether size instances are done, waiting at most timeout seconds for it
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while len(self.summaries) < size:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+
+class Counters(object):
+    """
+    messages and bytes queued into and taken out of mailboxes, and the seconds they waited in between
+    """
+
+    def __init__(self):
+        self.messages_in = self.bytes_in = self.messages_out = self.bytes_out = 0
+        self.wait = self.max_wait = 0.0
+
+    def put(self, size: int):
+        self.messages_in += 1
+        self.bytes_in += size
+
+    def took(self, size: int, wait: float):
+        self.messages_out += 1
+        self.bytes_out += size
+        self.wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def summary(self) -> dict:
+        return {'messages in': self.messages_in, 'bytes in': self.bytes_in, 'messages out': self.messages_out,
+                'bytes out': self.bytes_out, 'mean queue wait': self.wait / max(self.messages_out, 1),
+                'max queue wait': self.max_wait}
+
+
+totals = Counters()  # of all the mailboxes this shard ever owned
+refused = 0  # requests refused with 429
+
+
+class Mailbox(object):
+    def __init__(self):
+        self.msgs_q = asyncio.Queue()
+        self.bytes = 0
+        self.taken = asyncio.Event()  # set whenever messages are taken out, wakes up senders waiting for room
+        # time every queued message was put, oldest first, only kept with METRICS
+        self.put_times: Deque[float] = collections.deque()
+        self.counters = Counters()
+
+    def has_room(self, count: int, size: int) -> bool:
+        return self.msgs_q.empty() or (self.msgs_q.qsize() + count <= MAILBOX_MAX_MESSAGES and
+                                       self.bytes + size <= MAILBOX_MAX_BYTES)
+
+    def put(self, payload: bytes):
+        self.msgs_q.put_nowait(payload)
+        self.bytes += len(payload)
+        if METRICS:
+            self.put_times.append(time.monotonic())
+            self.counters.put(len(payload))
+            totals.put(len(payload))
+
+    def took(self, payload: Optional[bytes]) -> Optional[bytes]:
+        if payload is not None:
+            self.bytes -= len(payload)
+            if METRICS:
+                wait = time.monotonic() - self.put_times.popleft()
+                self.counters.took(len(payload), wait)
+                totals.took(len(payload), wait)
+        self.taken.set()
+        return payload
+
+    async def get(self) -> Optional[bytes]:
+        return self.took(await self.msgs_q.get())
+
+    def get_nowait(self) -> Optional[bytes]:
+        return self.took(self.msgs_q.get_nowait())
+
+    def close(self):
+        # None wakes up a pending read of the peer, which then returns 204
+        self.msgs_q.put_nowait(None)
+        self.taken.set()
+
+
+class MailboxFull(Exception):
+    pass
+
+
+async def wait_for_room(messages: List[Tuple[Mailbox, bytes]], timeout: Optional[float]) -> bool:
+    """
+    :return: whether every mailbox has room for its messages, waiting at most timeout seconds for it
+    """
+    needed: Dict[Mailbox, List[int]] = {}
+    for mailbox, payload in messages:
+        count_size = needed.setdefault(mailbox, [0, 0])
+        count_size[0] += 1
+        count_size[1] += len(payload)
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while True:
+        full = next((mailbox for mailbox, (count, size) in needed.items() if not mailbox.has_room(count, size)), None)
+        if full is None:
+            return True
+        remaining = None if deadline is None else deadline - loop.time()
+        if remaining is not None and remaining <= 0:
+            return False
+        full.taken.clear()
+        try:
+            await asyncio.wait_for(full.taken.wait(), remaining)
+        except asyncio.TimeoutError:
+            return False
+
+
+def owner(puid: str) -> Optional[str]:
+    """
+    :return: base url of the shard owning the mailbox of puid, None if it is this one
+    """
+    if not SHARDS:
+        return None
+    shard = ring.owner(puid)
+    return None if shard == SHARDS[SHARD_INDEX] else shard
+
+
+def call_shard(method: str, url: str, data: Optional[bytes] = None) -> bytes:
+    request = urllib.request.Request(url, data=data, method=method, headers={'Content-Type': OCTET_STREAM})
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+async def forward(method: str, url: str, data: Optional[bytes] = None) -> bytes:
+    return await asyncio.get_running_loop().run_in_executor(None, call_shard, method, url, data)
+
+
+async def open_mailbox(puid: str):
+    shard = owner(puid)
+    if shard is None:
+        mailboxes[puid] = Mailbox()
+    else:
+        await forward('POST', f'{shard}/mailboxes/?puid={puid}')
+
+
+async def close_mailbox(puid: str):
+    shard = owner(puid)
+    if shard is not None:
+        await forward('DELETE', f'{shard}/mailboxes/?puid={puid}')
+    elif puid in mailboxes:
+        mailboxes.pop(puid).close()
+
+
+@app.post("/mailboxes/")
+async def post_mailboxes(puid: str):
+    await open_mailbox(puid)
+    return puid
+
+
+@app.delete("/mailboxes/")
+async def delete_mailboxes(puid: str):
+    await close_mailbox(puid)
+    return puid
+
+
+def redirect_to_first_shard(request: Request) -> RedirectResponse:
+    return RedirectResponse(f'{SHARDS[0]}{request.url.path}?{request.url.query}', status_code=307)
+
+
 @app.get("/register/")
-async def get_register(request: Request):
-    ip = request.client.host
-    port = request.client.port
+async def get_register(request: Request, host: Optional[str] = None, port: Optional[int] = None,
+                       job: str = 'default', size: Optional[int] = None, uid: Optional[int] = None):
+    """
+    :param host, port: address the peer accepts direct connections on, host defaults to the address seen by the server.
+    Peers registered without port can only be reached through the relay.
+    :param job, size: registration returns once size peers have registered for job, size defaults to PEERS_NUM.
+    The job name can be reused once all of them have registered.
+    :param uid: uid the peer asks for, e.g. the one whose sub-graph it still has from an invocation before
+    """
+    if SHARD_INDEX != 0:
+        return redirect_to_first_shard(request)
+    size = PEERS_NUM if size is None else size
+    if job not in jobs:
+        jobs[job] = Job(job, size)
+    _job = jobs[job]
+    if _job.size != size:
+        return Response(status_code=409, content=f'job {job} has size {_job.size}, not {size}')
+    ip = request.client.host if host is None else host
+    direct = port is not None
+    port = request.client.port if port is None else port
 
-    peer = Peer(ip=ip, port=port)
-    logger.debug(f'receive register request from {ip}:{port}, create {peer}')
+    peer = Peer(ip=ip, port=port, direct=direct, job=_job)
+    logger.debug('receive register request from %s:%s, create %s', ip, port, peer)
+    await open_mailbox(peer.puid)
     peers.update({peer.puid: peer})
-    logger.debug(len(peers))
-    # length of peers will be modified by the others
-    while len(peers) < PEERS_NUM:
-        await asyncio.sleep(0.01)
+    _job.add(peer, uid)
+    logger.debug('job %s: %d/%d', job, len(_job.peers), size)
+    if _job.complete.is_set():
+        del jobs[job]
+    await _job.complete.wait()
 
-    return {'puid': peer.puid, 'peers': tuple(peers), }
+    return {'puid': peer.puid,
+            'peers': tuple(p.puid for p in _job.members),
+            'addresses': tuple((p.ip, p.port) if p.direct else None for p in _job.members),
+            'shards': SHARDS,
+            }
 
 
 @app.delete("/unregister/")
-async def delete_register(src: str):
+async def delete_register(request: Request, src: str):
+    if SHARD_INDEX != 0:
+        return redirect_to_first_shard(request)
     if src in peers:
-        del peers[src]
+        peer = peers.pop(src)
+        peer.job.peers.pop(src, None)
+        if not peer.job.peers and jobs.get(peer.job.name) is peer.job:  # nobody is waiting for the job anymore
+            del jobs[peer.job.name]
+        await close_mailbox(src)
     else:
         logger.warning(f'{src} is not in peers list')
     return src
 
 
+@app.get("/barrier/")
+async def get_barrier(request: Request, src: str, name: str = ''):
+    """
+    returns once every peer of the job of src has called the barrier of the same name, barriers are reusable
+    """
+    if SHARD_INDEX != 0:
+        return redirect_to_first_shard(request)
+    if src not in peers:
+        return Response(status_code=404)
+    await peers[src].job.barrier(name).wait()
+    return name
+
+
+@app.post("/completions/")
+async def post_completions(request: Request, job: str = 'default'):
+    """
+    an instance of job is done, the body is its summary as JSON. Failed instances post too, so nobody waits for them.
+    """
+    if SHARD_INDEX != 0:
+        return redirect_to_first_shard(request)
+    completions.setdefault(job, Completions()).add(await request.json())
+    return job
+
+
+@app.get("/completions/")
+async def get_completions(request: Request, job: str = 'default', size: int = 1, timeout: Optional[float] = None):
+    """
+    returns once size instances of job are done, or after timeout seconds with the summaries posted so far. The job name
+    can be reused once it returned complete.
+    """
+    if SHARD_INDEX != 0:
+        return redirect_to_first_shard(request)
+    _completions = completions.setdefault(job, Completions())
+    complete = await _completions.wait(size, timeout)
+    if complete and completions.get(job) is _completions:
+        del completions[job]
+    return {'job': job, 'complete': complete, 'summaries': _completions.summaries}
+
+
+async def route(entries: Iterable[Tuple[str, bytes]], timeout: Optional[float] = None):
+    """
+    :param timeout: seconds to wait for room in full mailboxes, None waits as long as it takes
+    :raise MailboxFull: nothing has been queued locally because a mailbox had no room left, or a shard owning some of
+    the mailboxes refused their messages
+    """
+    local: List[Tuple[Mailbox, bytes]] = []
+    foreign: Dict[str, List[Tuple[str, bytes]]] = {}
+    for dst, payload in entries:
+        shard = owner(dst)
+        if shard is not None:
+            foreign.setdefault(shard, []).append((dst, payload))
+        elif dst in mailboxes:
+            local.append((mailboxes[dst], payload))
+        else:
+            logger.warning(f'drop message to {dst}, it has no mailbox')
+    if not await wait_for_room(local, timeout):
+        raise MailboxFull()
+    for mailbox, payload in local:
+        mailbox.put(payload)
+    # messages for mailboxes of other shards, e.g. sent through a websocket
+    results = await asyncio.gather(*(forward('POST', f'{shard}/messages/', pack_batch(batch))
+                                     for shard, batch in foreign.items()), return_exceptions=True)
+    for result in results:
+        if isinstance(result, urllib.error.HTTPError) and result.code == 429:
+            raise MailboxFull()
+        if isinstance(result, Exception):
+            raise result
+
+
+def too_many_requests() -> Response:
+    global refused
+    refused += 1
+    return Response(status_code=429, headers={'Retry-After': str(RETRY_AFTER)})
+
+
 @app.post("/messages/")
-async def post_messages(dst: str, msg: Data):
-    await peers[dst].msgs_q.put(msg)
-    logger.debug(f'dst = {dst}, data = {msg}')
-    return msg
+async def post_messages(request: Request, dst: Optional[str] = None):
+    """
+    without dst, the body is a multi-destination batch packed by protocol.pack_batch. A batch is queued as a whole or,
+    if some mailbox is full, refused as a whole with 429.
+    """
+    # mailboxes always hold raw bytes, so binary and JSON peers can talk to each other
+    if dst is None:
+        try:
+            await route(unpack_batch(await request.body()), BACKPRESSURE_TIMEOUT)
+        except MailboxFull:
+            return too_many_requests()
+        return dst
+    if owner(dst) is None and dst not in mailboxes:
+        return Response(status_code=404)
+    if request.headers.get('content-type', '').startswith(OCTET_STREAM):
+        payload = await request.body()
+    else:
+        payload = base64.b64decode(Data(**await request.json()).payload)
+    try:
+        await route(((dst, payload),), BACKPRESSURE_TIMEOUT)
+    except MailboxFull:
+        return too_many_requests()
+    logger.debug('dst = %s, %d bytes', dst, len(payload))
+    return dst
 
 
 @app.get("/messages/")
-async def read_message(src: str):
-    msg = await peers[src].msgs_q.get()
-    logger.debug(f'src = {src}, data = {msg}')
-    return msg
+async def read_message(src: str, request: Request, max_n: Optional[int] = None, timeout: Optional[float] = None):
+    """
+    with max_n, up to max_n queued messages are returned as one batch. The request waits at most timeout seconds for
+    the first message and returns an empty batch if nothing arrives.
+    """
+    if src not in mailboxes:  # unregistered
+        return Response(status_code=204)
+    mailbox = mailboxes[src]
+    if max_n is not None:
+        try:
+            payloads = [await asyncio.wait_for(mailbox.get(), timeout)]
+        except asyncio.TimeoutError:
+            payloads = []
+        while payloads and payloads[-1] is not None and len(payloads) < max_n and not mailbox.msgs_q.empty():
+            payloads.append(mailbox.get_nowait())
+        if payloads and payloads[-1] is None:
+            payloads.pop()
+            if not payloads:
+                return Response(status_code=204)
+        logger.debug('src = %s, %d messages', src, len(payloads))
+        return Response(content=pack_batch((None, payload) for payload in payloads), media_type=OCTET_STREAM)
+
+    payload = await mailbox.get()
+    if payload is None:
+        return Response(status_code=204)
+    logger.debug('src = %s, %d bytes', src, len(payload))
+    if OCTET_STREAM in request.headers.get('accept', ''):
+        return Response(content=payload, media_type=OCTET_STREAM)
+    return {'payload': base64.b64encode(payload).decode('utf8')}
+
+
+@app.websocket("/ws/{puid}")
+async def websocket_messages(websocket: WebSocket, puid: str):
+    """
+    persistent channel of a peer. Messages of its mailbox are pushed as binary frames as soon as they arrive, every
+    frame received from the peer is a batch packed by protocol.pack_batch, it is acknowledged by a text frame once routed.
+    While a destination mailbox is full, no further frame is read, which pushes back on the peer.
+    """
+    await websocket.accept()
+    mailbox = mailboxes.get(puid)
+    if mailbox is None:  # unknown or unregistered, the HTTP endpoints answer 404
+        await websocket.close(code=1008)  # policy violation
+        return
+    # acknowledgements are sent by the pusher, reading frames never waits until the peer reads
+    acks = asyncio.Queue()
+
+    async def push():
+        payload_get = asyncio.ensure_future(mailbox.get())
+        ack_get = asyncio.ensure_future(acks.get())
+        try:
+            while True:
+                done, _ = await asyncio.wait((payload_get, ack_get), return_when=asyncio.FIRST_COMPLETED)
+                if ack_get in done:
+                    await websocket.send_text(ack_get.result())
+                    ack_get = asyncio.ensure_future(acks.get())
+                if payload_get in done:
+                    payload = payload_get.result()
+                    if payload is None:  # unregistered
+                        await websocket.close()
+                        break
+                    await websocket.send_bytes(payload)
+                    payload_get = asyncio.ensure_future(mailbox.get())
+        finally:
+            payload_get.cancel()
+            ack_get.cancel()
+
+    pusher = asyncio.create_task(push())
+    try:
+        while True:
+            entries = list(unpack_batch(await websocket.receive_bytes()))
+            while True:
+                try:
+                    await route(entries)
+                    break
+                except MailboxFull:  # refused by another shard, the receivers drop duplicates of the retry
+                    await asyncio.sleep(RETRY_AFTER)
+            acks.put_nowait('ack')
+    except WebSocketDisconnect:
+        logger.debug('%s disconnected', puid)
+    finally:
+        pusher.cancel()
+
+
+@app.get("/stats/")
+async def get_stats():
+    """
+    depth and size of the mailboxes owned by this shard
+    """
+    return {'mailboxes': {puid: {'messages': mailbox.msgs_q.qsize(), 'bytes': mailbox.bytes}
+                          for puid, mailbox in mailboxes.items()},
+            'messages': sum(mailbox.msgs_q.qsize() for mailbox in mailboxes.values()),
+            'bytes': sum(mailbox.bytes for mailbox in mailboxes.values()),
+            'max_messages': MAILBOX_MAX_MESSAGES,
+            'max_bytes': MAILBOX_MAX_BYTES,
+            }
+
+
+@app.get("/metrics/")
+async def get_metrics():
+    """
+    messages and bytes in and out of every mailbox owned by this shard and how long messages waited in it, totals
+    include the mailboxes of peers that unregistered
+    """
+    return {'enabled': METRICS,
+            'totals': totals.summary(),
+            'refused': refused,
+            'mailboxes': {puid: mailbox.counters.summary() for puid, mailbox in mailboxes.items()},
+            }
 
 
 if __name__ == '__main__':
-    uvicorn.run(app, host='172.31.20.160')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='172.31.20.160')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--peers', type=int, default=PEERS_NUM, help='number of peers registration waits for')
+    parser.add_argument('--shards', default='', help='comma separated base urls of all shards, e.g. '
+                                                     'http://10.0.0.1:8000,http://10.0.0.1:8001')
+    parser.add_argument('--shard-index', type=int, default=0, help='index of this server in --shards')
+    parser.add_argument('--max-messages', type=int, default=MAILBOX_MAX_MESSAGES, help='message limit of a mailbox')
+    parser.add_argument('--max-bytes', type=int, default=MAILBOX_MAX_BYTES, help='byte limit of a mailbox')
+    parser.add_argument('--backpressure-timeout', type=float, default=BACKPRESSURE_TIMEOUT,
+                        help='seconds a message waits for room in a full mailbox before it is refused with 429')
+    parser.add_argument('--no-metrics', action='store_true', help='do not count messages for /metrics/')
+    args = parser.parse_args()
+    METRICS = not args.no_metrics
+    PEERS_NUM = args.peers
+    MAILBOX_MAX_MESSAGES = args.max_messages
+    MAILBOX_MAX_BYTES = args.max_bytes
+    BACKPRESSURE_TIMEOUT = args.backpressure_timeout
+    if args.shards:
+        SHARDS = tuple(args.shards.split(','))
+        SHARD_INDEX = args.shard_index
+        ring = HashRing(SHARDS)
+        logger.info(f'shard {SHARD_INDEX} of {SHARDS}')
+    logger.info(f'PEERS_NUM = {PEERS_NUM}')
+    uvicorn.run(app, host=args.host, port=args.port)
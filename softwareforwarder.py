@@ -1,19 +1,622 @@
 import base64
+import collections
 import functools
+import io
+import itertools
 import logging
 import multiprocessing
 import multiprocessing.connection
+import operator
 import pickle
+import queue
+import socket
+import threading
 import time
-from typing import Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Tuple, Dict, List, Optional, Union, Set
 
 import requests
 
+from protocol import OCTET_STREAM, MESSAGE_HEADER, USER_CHANNEL, COLLECTIVE_CHANNEL, HashRing, ACK_HEADER, pack_batch, \
+    unpack_batch, pack_frames, read_frame
+
 FORMAT = f"%(filename)-13s|%(funcName)-10s|%(lineno)-3d|%(message)s"
 logging.basicConfig(format=FORMAT)
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
+# binary: pickled messages are carried as raw application/octet-stream bodies
+# json: legacy {'payload': <base64>} envelope, kept for servers that predate the binary transport
+# websocket: one persistent connection per peer carries both directions
+TRANSPORTS = ('binary', 'json', 'websocket')
+# process: send and receive loops run in child processes connected by multiprocessing.Pipe
+# thread: they run as background threads of the calling process connected by in-process queues
+ENGINES = ('process', 'thread')
+# seconds to wait for a direct connection before falling back to the relay
+CONNECT_TIMEOUT = 1.0
+# seconds to wait for a peer to acknowledge directly sent messages before they are relayed
+ACK_TIMEOUT = 10.0
+# a failed relay request is retried RETRIES times, waiting RETRY_BACKOFF * 2 ** n seconds before retry n
+RETRIES = 3
+RETRY_BACKOFF = 0.1
+# a request refused with 429 because a mailbox is full is retried after Retry-After for up to BACKPRESSURE_TIMEOUT
+# seconds, without counting as failed attempt
+BACKPRESSURE_TIMEOUT = 300.0
+# seconds to wait for the loops to finish an invocation after unregister, loops that did not are stopped
+SHUTDOWN_TIMEOUT = 5.0
+# workers of finished invocations kept for the next invocation of a warm Lambda container, the least recently used are
+# stopped first
+IDLE_WORKERS = 2
+
+_EMPTY = object()
+# sent to idle loops instead of a registration, they exit
+STOP = 'stop'
+
+
+class QueueConnection(object):
+    """
+    In-process stand-in for one end of multiprocessing.Pipe used by the thread engine, so that send and receive loops
+    work with both engines. Objects are handed over by reference instead of being pickled.
+    """
+
+    def __init__(self, q: queue.SimpleQueue):
+        self.queue = q
+        self.pending = _EMPTY  # item taken from the queue by poll()
+
+    def send(self, obj):
+        self.queue.put(obj)
+
+    send_bytes = send
+
+    def recv(self):
+        if self.pending is not _EMPTY:
+            obj, self.pending = self.pending, _EMPTY
+            return obj
+        return self.queue.get()
+
+    recv_bytes = recv
+
+    def poll(self, timeout: Optional[float] = 0.0) -> bool:
+        if self.pending is _EMPTY:
+            try:
+                self.pending = self.queue.get(timeout=timeout) if timeout is None or timeout > 0 else \
+                    self.queue.get_nowait()
+            except queue.Empty:
+                return False
+        return True
+
+    def close(self):
+        pass
+
+
+def queue_pipe(duplex: bool = False) -> Tuple[QueueConnection, QueueConnection]:
+    """
+    same signature as multiprocessing.Pipe, only one-way pipes are supported
+    """
+    if duplex:
+        raise ValueError('queue_pipe is one-way only')
+    q = queue.SimpleQueue()
+    return QueueConnection(q), QueueConnection(q)
+
+
+def unbounded(pipe: multiprocessing.connection.Connection,
+              objects: bool = False) -> multiprocessing.connection.Connection:
+    """
+    in-process buffer in front of pipe, drained into it by a thread. The loops hand payloads and acknowledgements over
+    without blocking while the pipe is full, e.g. while the calling process is busy sending and does not read it, so
+    they keep reading acknowledgements and frames meanwhile.
+    :param objects: pipe carries objects, e.g. pipe_ack, rather than payloads
+    """
+    if isinstance(pipe, QueueConnection):  # thread engine, unbounded already
+        return pipe
+    buffer_r, buffer_s = queue_pipe()
+    forward = pipe.send if objects else pipe.send_bytes
+
+    def drain():
+        while True:
+            forward(buffer_r.recv())
+
+    threading.Thread(target=drain, daemon=True).start()
+    return buffer_s
+
+
+class AckTracker(object):
+    """
+    Messages sent by this peer that have not been acknowledged yet, by (destination uid, sequence number) since every
+    destination counts sequence numbers of its own. Acknowledgements are reported by the send loop through pipe_ack as
+    (list of such keys, delivered) tuples.
+    """
+
+    def __init__(self, pipe_ack: multiprocessing.connection.Connection):
+        self.pipe_ack = pipe_ack
+        self.pending: Set[Tuple[int, int]] = set()
+        self.failed: Set[Tuple[int, int]] = set()
+        self.closed = False  # the send loop is done with the invocation
+
+    def collect(self, timeout: Optional[float] = 0.0):
+        """
+        apply all reported acknowledgements, waiting at most timeout for the first one
+        """
+        while self.pipe_ack.poll(timeout):
+            ack = self.pipe_ack.recv()
+            if ack is None:
+                self.closed = True
+                break
+            keys, delivered = ack
+            self.pending.difference_update(keys)
+            if not delivered:
+                self.failed.update(keys)
+            timeout = 0.0
+
+    def wait(self, keys: Set[Tuple[int, int]], timeout: Optional[float] = None) -> bool:
+        """
+        :return: False if some of keys are still pending after timeout seconds
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        self.collect()
+        while not self.pending.isdisjoint(keys):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.collect(remaining)
+        return True
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        return self.wait(set(self.pending), timeout)
+
+    def close(self, timeout: float) -> bool:
+        """
+        wait until the send loop reports that it is done with the invocation, after the acknowledgements before
+        :return: False if it did not within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while not self.closed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.collect(remaining)
+        return True
+
+
+class Ticket(object):
+    """
+    returned by sen(), it is done once the server or the receiving peer has acknowledged the message
+    """
+
+    def __init__(self, key: Tuple[int, int], acks: AckTracker):
+        self.key = key  # destination uid, sequence number
+        self.acks = acks
+
+    def done(self) -> bool:
+        self.acks.collect()
+        return self.key not in self.acks.pending
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        :return: True if the message has been delivered, False if delivery failed or timeout expired
+        """
+        return self.acks.wait({self.key}, timeout) and self.key not in self.acks.failed
+
+
+class Metrics(object):
+    """
+    Counters of the calling process of a peer, in the event as metrics unless it is disabled: messages and bytes sent to
+    and received from every peer (uid), collective messages included, and the seconds spent pickling and unpickling
+    messages and blocked in rec()
+    """
+
+    def __init__(self):
+        self.sent: Dict[int, List[int]] = collections.defaultdict(lambda: [0, 0])  # {uid:[messages, bytes]}
+        self.received: Dict[int, List[int]] = collections.defaultdict(lambda: [0, 0])
+        self.serialization = 0.0
+        self.deserialization = 0.0
+        self.blocked = 0.0
+
+    @staticmethod
+    def count(counters: Dict[int, List[int]], uid: int, size: int):
+        counter = counters[uid]
+        counter[0] += 1
+        counter[1] += size
+
+    def summary(self) -> Dict:
+        return {'sent': {uid: {'messages': messages, 'bytes': size} for uid, (messages, size) in
+                         sorted(self.sent.items())},
+                'received': {uid: {'messages': messages, 'bytes': size} for uid, (messages, size) in
+                             sorted(self.received.items())},
+                'serialization': self.serialization,
+                'deserialization': self.deserialization,
+                'blocked': self.blocked,
+                }
+
+
+class SequenceFilter(object):
+    """
+    Drops messages that arrive more than once, e.g. after a retried request. Senders count sequence numbers per
+    destination, so they have no gaps here. Per sender only the highest sequence number below which everything has
+    arrived, plus the sequence numbers received out of order above it, are kept.
+    """
+
+    def __init__(self):
+        self.floor: Dict[int, int] = {}
+        self.above: Dict[int, Set[int]] = collections.defaultdict(set)
+
+    def accept(self, src: int, seq: int) -> bool:
+        floor = self.floor.get(src, 0)
+        above = self.above[src]
+        if seq <= floor or seq in above:
+            return False
+        above.add(seq)
+        while floor + 1 in above:
+            floor += 1
+            above.remove(floor)
+        self.floor[src] = floor
+        return True
+
+
+class Inbox(object):
+    """
+    Receiving end of the calling process. Payloads read from pipe_rec are deduplicated and split by channel, user
+    messages are queued for rec() and collective messages are kept until the collective operation asks for them.
+    """
+
+    def __init__(self, pipe_rec: multiprocessing.connection.Connection, metrics: Optional[Metrics] = None):
+        self.pipe_rec = pipe_rec
+        self.received = SequenceFilter()
+        self.user: Deque[memoryview] = collections.deque()
+        # (collective operation id, src uid) -> value
+        self.collective: Dict[Tuple[int, int], Any] = {}
+        self.metrics = metrics
+
+    def read(self):
+        payload = self.pipe_rec.recv_bytes()
+        src, seq, channel = MESSAGE_HEADER.unpack_from(payload)
+        if not self.received.accept(src, seq):
+            return
+        if self.metrics is not None:
+            self.metrics.count(self.metrics.received, src, len(payload))
+        body = memoryview(payload)[MESSAGE_HEADER.size:]
+        if channel == USER_CHANNEL:
+            # unpickled by rec(), after the messages queued before it
+            self.user.append(body)
+        else:
+            op_id, value = self.loads(body)
+            self.collective[op_id, src] = value
+
+    def loads(self, body: memoryview) -> Any:
+        if self.metrics is None:
+            return pickle.loads(body)
+        start = time.perf_counter()
+        msg = pickle.loads(body)
+        self.metrics.deserialization += time.perf_counter() - start
+        return msg
+
+    def rec(self, timeout: Optional[float] = None):
+        """
+        :param timeout: seconds to wait for a message, None waits until one arrives
+        :raise queue.Empty: no message arrived within timeout, e.g. rec(0) polls
+        """
+        if not self.user:
+            start = time.perf_counter() if self.metrics is not None else 0.0
+            deadline = None if timeout is None else time.monotonic() + timeout
+            try:
+                while not self.user:
+                    if deadline is not None and not self.pipe_rec.poll(max(deadline - time.monotonic(), 0)):
+                        raise queue.Empty
+                    self.read()
+            finally:
+                if self.metrics is not None:
+                    self.metrics.blocked += time.perf_counter() - start
+        return self.loads(self.user.popleft())
+
+    def take(self, op_id: int, src: int):
+        while (op_id, src) not in self.collective:
+            self.read()
+        return self.collective.pop((op_id, src))
+
+    def close(self, timeout: float) -> bool:
+        """
+        drop whatever arrives until the receive loop reports with an empty payload that it is done with the invocation
+        :return: False if it did not within timeout seconds
+        """
+        deadline = time.monotonic() + timeout
+        while self.pipe_rec.poll(max(deadline - time.monotonic(), 0)):
+            if not self.pipe_rec.recv_bytes():
+                return True
+        return False
+
+
+class Collectives(object):
+    """
+    Collective operations over the point to point messages of the forwarder. Every instance of the job has to call the
+    same operations in the same order, the n-th operation of every instance is matched by its id n.
+
+    broadcast, reduce and gather use a binomial tree rooted at root: P - 1 messages in ceil(log2 P) rounds instead of
+    P - 1 messages sent one after the other by the root, or P * (P - 1) messages when every instance sends to everyone.
+    allreduce is a reduce followed by a broadcast of the result, alltoall sends P - 1 messages per instance, as many
+    as there are distinct values to exchange.
+    """
+
+    def __init__(self, uid: int, peers: Tuple[int, ...], send: Callable[[int, Any], Any], inbox: Inbox):
+        """
+        :param send: send(dst uid, (operation id, value)) puts the value on the collective channel
+        """
+        self.uid = uid
+        self.peers = peers
+        self.send = send
+        self.inbox = inbox
+        self.op_ids = itertools.count()
+
+    def relative(self, root: int) -> Tuple[int, Callable[[int], int]]:
+        """
+        :return: rank of this instance in the tree rooted at root, function mapping a rank in that tree to a uid
+        """
+        size = len(self.peers)
+        offset = self.peers.index(root)
+        return (self.peers.index(self.uid) - offset) % size, lambda rank: self.peers[(rank + offset) % size]
+
+    def broadcast(self, value: Any = None, root: int = 1) -> Any:
+        """
+        :return: value of root on every instance
+        """
+        op_id = next(self.op_ids)
+        rank, to_uid = self.relative(root)
+        size = len(self.peers)
+        mask = 1
+        while mask < size:
+            if rank & mask:
+                value = self.inbox.take(op_id, to_uid(rank - mask))
+                break
+            mask <<= 1
+        mask >>= 1
+        while mask > 0:
+            if rank + mask < size:
+                self.send(to_uid(rank + mask), (op_id, value))
+            mask >>= 1
+        return value
+
+    def reduce(self, value: Any, op: Callable[[Any, Any], Any] = operator.add, root: int = 1) -> Any:
+        """
+        :param op: associative, values are combined in the order of the peers starting at root
+        :return: op applied to the values of all instances on root, None on the others
+        """
+        op_id = next(self.op_ids)
+        rank, to_uid = self.relative(root)
+        size = len(self.peers)
+        mask = 1
+        while mask < size:
+            if rank & mask:
+                self.send(to_uid(rank - mask), (op_id, value))
+                return None
+            if rank + mask < size:
+                value = op(value, self.inbox.take(op_id, to_uid(rank + mask)))
+            mask <<= 1
+        return value
+
+    def allreduce(self, value: Any, op: Callable[[Any, Any], Any] = operator.add) -> Any:
+        """
+        :return: op applied to the values of all instances, on every instance
+        """
+        return self.broadcast(self.reduce(value, op, self.peers[0]), self.peers[0])
+
+    def gather(self, value: Any, root: int = 1) -> Optional[Dict[int, Any]]:
+        """
+        :return: {uid: value} of all instances in the order of the peers on root, None on the others
+        """
+        gathered = self.reduce({self.uid: value}, lambda left, right: {**left, **right}, root)
+        return None if gathered is None else {uid: gathered[uid] for uid in self.peers}
+
+    def alltoall(self, values: Dict[int, Any]) -> Dict[int, Any]:
+        """
+        :param values: {dst uid: value sent to dst} for every other instance, a value for this instance itself is
+        returned without being sent
+        :return: {src uid: value sent by src to this instance}
+        """
+        op_id = next(self.op_ids)
+        for dst in self.peers:
+            if dst != self.uid:
+                self.send(dst, (op_id, values[dst]))
+        return {src: values.get(src) if src == self.uid else self.inbox.take(op_id, src) for src in self.peers}
+
+
+class DirectChannel(object):
+    """
+    Sending side of the direct peer to peer data plane. Connections are opened lazily, a peer that can not be reached is
+    remembered and its messages are left to the server relay from then on.
+    """
+
+    def __init__(self, addresses: Dict[int, Optional[Tuple[str, int]]], timeout: float = CONNECT_TIMEOUT,
+                 ack_timeout: float = ACK_TIMEOUT):
+        self.addresses = addresses
+        self.timeout = timeout
+        self.ack_timeout = ack_timeout
+        self.connections: Dict[int, Tuple[socket.socket, io.BufferedReader]] = {}
+        self.unreachable = {uid for uid, address in addresses.items() if address is None}
+
+    def connect(self, dst_uid: int) -> Tuple[socket.socket, io.BufferedReader]:
+        if dst_uid not in self.connections:
+            conn = socket.create_connection(self.addresses[dst_uid], timeout=self.timeout)
+            conn.settimeout(self.ack_timeout)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.connections[dst_uid] = conn, conn.makefile('rb')
+        return self.connections[dst_uid]
+
+    def disconnect(self, dst_uid: int):
+        conn, stream = self.connections.pop(dst_uid)
+        stream.close()
+        conn.close()
+
+    def send(self, batch: List[Tuple[int, int, bytes]]) -> Tuple[List[Tuple[int, int]], List[Tuple[int, int, bytes]]]:
+        """
+        :param batch: (dst uid, sequence number, payload) of every message
+        :return: (dst uid, sequence number) acknowledged by the receiving peers, messages that have to be relayed
+        """
+        acked, relay = [], []
+        grouped: Dict[int, List[Tuple[int, int, bytes]]] = {}
+        for message in batch:
+            if message[0] in self.unreachable:
+                relay.append(message)
+            else:
+                grouped.setdefault(message[0], []).append(message)
+        for dst_uid, messages in grouped.items():
+            try:
+                conn, stream = self.connect(dst_uid)
+            except OSError as e:
+                logger.warning(f'direct connection to {dst_uid} failed ({e}), fall back to relay')
+                self.unreachable.add(dst_uid)
+                relay.extend(messages)
+                continue
+            seqs = [seq for _, seq, _ in messages]
+            try:
+                conn.sendall(pack_frames(payload for _, _, payload in messages))
+                acks = stream.read(ACK_HEADER.size * len(messages))
+                if len(acks) < ACK_HEADER.size * len(messages) or \
+                        [seq for seq, in ACK_HEADER.iter_unpack(acks)] != seqs:
+                    raise ConnectionError('unexpected acknowledgement')
+            except OSError as e:
+                # the receiver drops the duplicates in case some of them did arrive
+                logger.warning(f'direct send to {dst_uid} failed ({e}), relay {len(messages)} messages')
+                self.disconnect(dst_uid)
+                relay.extend(messages)
+                continue
+            acked.extend((dst_uid, seq) for seq in seqs)
+        return acked, relay
+
+    def close(self):
+        for dst_uid in list(self.connections):
+            self.disconnect(dst_uid)
+
+
+def report_completion(url: str, job: str, summary: Dict):
+    """
+    tell whoever waits for the instances of job on the server, e.g. invoker.py, that this instance is done
+    :param summary: JSON serializable, failed instances report too
+    """
+    requests.post(url + '/completions/', params={'job': job}, json=summary).raise_for_status()
+
+
+def wait_completions(url: str, job: str, size: int, timeout: Optional[float] = None,
+                     poll: float = 60.0) -> List[Dict]:
+    """
+    :param timeout: seconds to wait for size instances of job to report completion, None waits as long as it takes
+    :param poll: seconds a single request waits on the server, short enough for proxies and load balancers
+    :return: the summaries reported, fewer than size after timeout
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+        remaining = poll if deadline is None else min(poll, max(deadline - time.monotonic(), 0.0))
+        response = requests.get(url + '/completions/', params={'job': job, 'size': size, 'timeout': remaining})
+        response.raise_for_status()
+        completions = response.json()
+        if completions['complete'] or (deadline is not None and time.monotonic() >= deadline):
+            return completions['summaries']
+        logger.info(f'{len(completions["summaries"])}/{size} instances of {job} are done')
+
+
+class Workers(object):
+    """
+    Pipes, HTTP session and send/receive loops of a forwarder. They outlive the invocation, Lambda keeps the process of
+    a warm container, and the next invocation with the same settings reuses them if they are healthy. The loops are
+    handed the registration of every invocation and report when they are done with it, the send loop with None on
+    pipe_ack and the receive loop with an empty payload on pipe_rec.
+    """
+
+    def __init__(self, forwarder: 'SoftwareForwarder'):
+        self.settings = forwarder.settings()
+        self.engine = forwarder.engine
+        pipe = multiprocessing.Pipe if self.engine == 'process' else queue_pipe
+        self.pipe_rec_r, self.pipe_rec_s = pipe(duplex=False)
+        self.pipe_sen_r, self.pipe_sen_s = pipe(duplex=False)
+        self.pipe_ack_r, self.pipe_ack_s = pipe(duplex=False)
+        # registration, barriers and unregistration of the calling process
+        self.session = requests.Session()
+        self.listener, self.port = None, None
+        if forwarder.direct:
+            self.listener = forwarder.listener = socket.create_server(('0.0.0.0', 0))
+            self.port = self.listener.getsockname()[1]
+        if forwarder.transport == 'websocket':  # registrations come through pipe_sen
+            self.pipe_reg_r, self.pipe_reg_s = None, None
+            self.workers = [forwarder.start_worker(forwarder.websocket, self.pipe_sen_r, self.pipe_rec_s,
+                                                   self.pipe_ack_s)]
+        else:
+            self.pipe_reg_r, self.pipe_reg_s = pipe(duplex=False)
+            self.workers = [forwarder.start_worker(forwarder.send, self.pipe_sen_r, self.pipe_ack_s),
+                            forwarder.start_worker(forwarder.receive, self.pipe_reg_r, self.pipe_rec_s)]
+        if self.listener is not None and self.engine == 'process':  # now owned by the receiving process
+            self.listener.close()
+            self.listener = None
+        self.active = False  # the loops are busy with an invocation
+
+    def healthy(self) -> bool:
+        """
+        every loop is alive and nothing of the invocation before is left in the pipes
+        """
+        return all(worker.is_alive() for worker in self.workers) and not self.pipe_rec_r.poll(0) and \
+            not self.pipe_ack_r.poll(0)
+
+    def start(self, registration: Dict):
+        self.active = True
+        self.pipe_sen_s.send(registration)
+        if self.pipe_reg_s is not None:
+            self.pipe_reg_s.send(registration)
+
+    def close(self, timeout: float = SHUTDOWN_TIMEOUT):
+        """
+        stop the loops. Loops of the process engine still running after timeout seconds are terminated, threads still
+        busy with an invocation are left behind as daemons.
+        """
+        if not self.active:
+            self.pipe_sen_s.send(STOP)
+            if self.pipe_reg_s is not None:
+                self.pipe_reg_s.send(STOP)
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if self.engine == 'process':
+                if worker.is_alive():
+                    logger.warning(f'{worker.name} did not stop, terminate it')
+                    worker.terminate()
+                    worker.join()
+                worker.close()
+        if self.listener is not None:
+            self.listener.close()
+        self.session.close()
+
+
+# idle workers, least recently used first
+_idle: List[Workers] = []
+_idle_lock = threading.Lock()
+
+
+def acquire_workers(forwarder: 'SoftwareForwarder') -> Workers:
+    """
+    :return: the most recently used idle workers with the settings of forwarder that are healthy, new ones otherwise
+    """
+    settings = forwarder.settings()
+    while True:
+        with _idle_lock:
+            workers = next((workers for workers in reversed(_idle) if workers.settings == settings), None)
+            if workers is None:
+                break
+            _idle.remove(workers)
+        if workers.healthy():
+            logger.info('reuse the workers of an invocation before')
+            return workers
+        logger.warning('workers of an invocation before are broken, stop them')
+        workers.close(0)
+    return Workers(forwarder)
+
+
+def release_workers(workers: Workers):
+    """
+    keep idle workers for the next invocation, at most IDLE_WORKERS of them
+    """
+    with _idle_lock:
+        _idle.append(workers)
+        evicted = _idle[:max(len(_idle) - IDLE_WORKERS, 0)]
+        del _idle[:len(evicted)]
+    for workers in evicted:
+        workers.close()
+
 
 class SoftwareForwarder(object):
     """
@@ -21,92 +624,428 @@ class SoftwareForwarder(object):
     easily and efficiently exchange states between each other.
     """
 
-    def __init__(self, url: str = 'http://172.31.20.160:8000'):
+    def __init__(self, url: str = 'http://172.31.20.160:8000', transport: str = 'binary', batch_size: int = 1,
+                 linger: float = 0.0, direct: bool = False, engine: str = 'process', flush_timeout: float = 60.0,
+                 job: str = 'default', size: Optional[int] = None, metrics: bool = True, reuse: bool = True,
+                 prefer_uid: Optional[int] = None):
+        """
+        :param batch_size: maximum number of messages coalesced into one HTTP request, 1 disables batching
+        :param linger: seconds the sender waits for more messages before posting a batch that is not full
+        :param direct: send messages over direct TCP connections between peers, the server is only used for
+        registration and as a relay for peers that can not be reached
+        :param engine: 'process' runs send and receive loops in child processes, 'thread' runs them as threads of the
+        calling process, which saves the process start up and a pickling round trip per message
+        :param flush_timeout: seconds to wait on exit until every sent message has been acknowledged
+        :param job: name of the group of instances running together
+        :param size: number of instances of the job, registration returns once all of them have registered. Defaults to
+        the PEERS_NUM of server.py
+        :param metrics: count messages, bytes and seconds of every invocation in a Metrics, passed in the event. The
+        cost of a disabled Metrics is a comparison per message.
+        :param reuse: keep pipes, HTTP sessions and loops for the next invocation in this process, e.g. of a warm Lambda
+        container, instead of starting them again
+        :param prefer_uid: uid asked for at registration, granted unless another instance of the job registered for it
+        before
+        """
+        if transport not in TRANSPORTS:
+            raise ValueError(f'transport must be one of {TRANSPORTS}, got {transport!r}')
+        if batch_size > 1 and transport == 'json':
+            raise ValueError('batching is not supported by the json transport')
+        if engine not in ENGINES:
+            raise ValueError(f'engine must be one of {ENGINES}, got {engine!r}')
         self.url = url
+        self.transport = transport
+        self.batch_size = batch_size
+        self.linger = linger
+        self.direct = direct
+        self.engine = engine
+        self.flush_timeout = flush_timeout
+        self.job = job
+        self.size = size
+        self.metrics = metrics
+        self.reuse = reuse
+        self.prefer_uid = prefer_uid
         # AWS lambda will try to reuse existed object that means code of __init__ may be skipped.
         # All the code of init has to be static value. Dynamic code has to be moved to other method.
-        self.pipe_rec_r, self.pipe_rec_s = None, None
-        self.pipe_sen_r, self.pipe_sen_s = None, None
+        # Pipes and loops are kept by the module in Workers, the peers below are set by route() every invocation.
         self.original_peers = None
         self.peers = None
         self.puid = None
         self.uid = None
         self.peers_original_peers_mapping = None
+        self.peers_addresses = None
+        self.peers_shards = None
+        self.listener = None
 
     def __call__(self, func):
         @functools.wraps(func)
         def wrapper(*args, **kw):
-            self.pipe_rec_r, self.pipe_rec_s = multiprocessing.Pipe(duplex=False)
-            self.pipe_sen_r, self.pipe_sen_s = multiprocessing.Pipe(duplex=False)
-
-            def sen(dst, msg):
-                self.pipe_sen_s.send((dst, msg))
+            workers = acquire_workers(self)
+            acks = AckTracker(workers.pipe_ack_r)
+            seqs = collections.defaultdict(lambda: itertools.count(1))  # per destination
+            metrics = Metrics() if self.metrics else None
+            inbox = Inbox(workers.pipe_rec_r, metrics)
 
-            def rec():
-                return self.pipe_rec_r.recv()
+            # messages are pickled exactly once here, send/receive processes only move bytes around
+            def send(dst, msg, channel: int) -> Ticket:
+                seq = next(seqs[dst])
+                start = time.perf_counter() if metrics is not None else 0.0
+                payload = MESSAGE_HEADER.pack(self.uid, seq, channel) + \
+                    pickle.dumps(msg, protocol=pickle.HIGHEST_PROTOCOL)
+                if metrics is not None:
+                    metrics.serialization += time.perf_counter() - start
+                    metrics.count(metrics.sent, dst, len(payload))
+                acks.pending.add((dst, seq))
+                workers.pipe_sen_s.send((dst, seq, payload))
+                return Ticket((dst, seq), acks)
 
-            # register
-            response = requests.get(self.url + '/register/')
-            logger.info('register finished')
-            self.original_peers: Tuple[str] = tuple(response.json()['peers'])
-            self.peers = tuple(range(1, len(self.original_peers) + 1))
-            self.puid: str = response.json()['puid']
-            self.uid: int = self.original_peers.index(self.puid) + 1
-            self.peers_original_peers_mapping: Dict[int, str] = dict(zip(self.peers, self.original_peers))
+            def sen(dst, msg) -> Ticket:
+                return send(dst, msg, USER_CHANNEL)
 
-            receive_process = multiprocessing.Process(target=self.receive, args=(self.pipe_rec_s,))
-            send_process = multiprocessing.Process(target=self.send, args=(self.pipe_sen_r,))
-            receive_process.start()
-            send_process.start()
+            def barrier(name: str = ''):
+                """
+                block until every instance of the job has called barrier with the same name. Messages sent before have
+                been acknowledged by then.
+                """
+                if not acks.flush(self.flush_timeout):
+                    logger.warning(f'barrier(): {len(acks.pending)} messages are not acknowledged')
+                workers.session.get(self.url + '/barrier/',
+                                    params={'src': self.puid, 'name': name}).raise_for_status()
 
-            args[0].update({'sen': sen,
-                            'rec': rec,
-                            'uid': self.uid,
-                            'peers': self.peers,
-                            })
+            try:
+                # register
+                params = {'job': self.job}
+                if self.size is not None:
+                    params['size'] = self.size
+                if workers.port is not None:
+                    params['port'] = workers.port
+                if self.prefer_uid is not None:
+                    params['uid'] = self.prefer_uid
+                response = workers.session.get(self.url + '/register/', params=params)
+                response.raise_for_status()
+                logger.info('register finished')
+                registration = response.json()
+                self.route(registration)
+                workers.start(registration)
 
-            logger.info(f'user function "{func.__name__}" start')
-            func_return = func(*args, **kw)
-            logger.info(f'user function "{func.__name__}" returned')
+                collectives = Collectives(self.uid, self.peers, lambda dst, msg: send(dst, msg, COLLECTIVE_CHANNEL),
+                                          inbox)
+                args[0].update({'sen': sen,
+                                'rec': inbox.rec,
+                                'barrier': barrier,
+                                'uid': self.uid,
+                                'peers': self.peers,
+                                'broadcast': collectives.broadcast,
+                                'reduce': collectives.reduce,
+                                'allreduce': collectives.allreduce,
+                                'gather': collectives.gather,
+                                'alltoall': collectives.alltoall,
+                                'metrics': metrics,
+                                })
 
-            # make sure pipe_sen_r is empty
-            while self.pipe_sen_r.poll():
-                time.sleep(0.01)
+                logger.info(f'user function "{func.__name__}" start')
+                func_return = func(*args, **kw)
+                logger.info(f'user function "{func.__name__}" returned')
 
-            receive_process.terminate()
-            send_process.terminate()
-
-            receive_process.join()
-            send_process.join()
+                # wait until the server or the receiving peers acknowledged every message
+                if not acks.flush(self.flush_timeout):
+                    logger.warning(f'{len(acks.pending)} messages are not acknowledged after {self.flush_timeout}s')
+                if acks.failed:
+                    logger.error(f'{len(acks.failed)} messages could not be delivered')
+            finally:
+                # registered, also when the user function failed: end the invocation of the sender, then unregister,
+                # which ends the pending long poll of the receiver
+                if workers.active:
+                    workers.pipe_sen_s.send(None)
+                    sent = acks.close(SHUTDOWN_TIMEOUT)
+                    try:
+                        workers.session.delete(self.url + '/unregister/', params={'src': self.puid})
+                        received = inbox.close(SHUTDOWN_TIMEOUT)
+                    except requests.RequestException as e:
+                        logger.error(f'unregister failed, {e}')
+                        received = False
+                    if sent and received:
+                        workers.active = False
+                    else:
+                        logger.warning('the loops did not finish the invocation, stop them')
+                # only idle loops are reused
+                if workers.active:
+                    workers.close(0)
+                elif self.reuse:
+                    release_workers(workers)
+                else:
+                    workers.close()
+            return func_return
 
-            receive_process.close()
-            send_process.close()
+        return wrapper
 
-            # unregister
-            requests.delete(self.url + '/unregister/', params={'src': self.puid})
+    def settings(self) -> Tuple:
+        """
+        what the loops depend on besides the peers of the invocation, workers are only reused with the same settings
+        """
+        return self.url, self.transport, self.batch_size, self.linger, self.direct, self.engine
 
-            return func_return
+    def route(self, registration: Dict):
+        """
+        peers of the invocation from the response of /register/, set by the wrapper and by the loops
+        """
+        self.original_peers: Tuple[str] = tuple(registration['peers'])
+        self.peers = tuple(range(1, len(self.original_peers) + 1))
+        self.puid: str = registration['puid']
+        self.uid: int = self.original_peers.index(self.puid) + 1
+        self.peers_original_peers_mapping: Dict[int, str] = dict(zip(self.peers, self.original_peers))
+        addresses = registration.get('addresses') or (None,) * len(self.peers)
+        self.peers_addresses = {uid: None if address is None else tuple(address)
+                                for uid, address in zip(self.peers, addresses)}
+        # base url of the server shard owning the mailbox of every peer
+        shards = registration.get('shards')
+        ring = HashRing(shards) if shards else None
+        self.peers_shards: Dict[int, str] = {uid: self.url if ring is None else ring.owner(puid)
+                                             for uid, puid in self.peers_original_peers_mapping.items()}
 
-        return wrapper
+    def start_worker(self, target, *args) -> Union[multiprocessing.Process, threading.Thread]:
+        # daemon, idle loops kept for the next invocation or stuck in a request must not keep the interpreter alive
+        if self.engine == 'process':
+            worker = multiprocessing.Process(target=target, args=args, daemon=True)
+        else:
+            worker = threading.Thread(target=target, args=args, daemon=True)
+        worker.start()
+        return worker
 
-    def receive(self, pipe_rec: multiprocessing.connection.Connection):
+    def receive(self, pipe_reg: multiprocessing.connection.Connection, pipe_rec: multiprocessing.connection.Connection):
         logger.info('receive() start!')
+        pipe_rec = unbounded(pipe_rec)
         with requests.sessions.Session() as session:
-            while True:
-                # TODO This infinitely get request will make uvicorn hard to terminate
-                response = session.get(self.url + '/messages/', params={'src': self.puid})
-                msg: Tuple[int, Dict] = pickle.loads(base64.b64decode((response.json()['payload'].encode('utf8'))))
-                logger.debug(f'receive(): client {self.puid} get msg: {msg}')
-                pipe_rec.send(msg)  # already implicitly acquire mutex
-
-    def send(self, pipe_sen: multiprocessing.connection.Connection):
+            if self.transport == 'binary':
+                session.headers.update({'Accept': OCTET_STREAM})
+            pipe_lock = threading.Lock()
+            if self.direct:
+                threading.Thread(target=self.serve_direct, args=(pipe_rec, pipe_lock), daemon=True).start()
+            # one registration per invocation until the workers are stopped
+            for registration in iter(pipe_reg.recv, STOP):
+                self.route(registration)
+                params = {'src': self.puid}
+                if self.batch_size > 1:
+                    params['max_n'] = self.batch_size
+                while True:
+                    response = session.get(self.peers_shards[self.uid] + '/messages/', params=params)
+                    if response.status_code == 204:  # unregistered
+                        break
+                    if self.batch_size > 1:
+                        payloads = [payload for _, payload in unpack_batch(response.content)]
+                    elif self.transport == 'binary':
+                        payloads = [response.content]
+                    else:
+                        payloads = [base64.b64decode(response.json()['payload'].encode('utf8'))]
+                    logger.debug('receive(): client %s get %d messages', self.puid, len(payloads))
+                    with pipe_lock:
+                        for payload in payloads:
+                            pipe_rec.send_bytes(payload)
+                with pipe_lock:  # done with the invocation
+                    pipe_rec.send_bytes(b'')
+        logger.info('receive() exit!')
+
+    def send(self, pipe_sen: multiprocessing.connection.Connection, pipe_ack: multiprocessing.connection.Connection):
         logger.info('send() start!')
-        with requests.sessions.Session() as session:
-            while True:
-                msg_tuple: tuple = pipe_sen.recv()
-                # find dst and payload from msg
-                dst = self.peers_original_peers_mapping[msg_tuple[0]]
-                # TODO haven't found the way to transfer binary data through fastAPI
-                msg = {'payload': base64.b64encode(pickle.dumps(msg_tuple[1])).decode('utf8')}
-                logger.debug(f'send(): send message to {dst}: {msg}')
-                session.post(self.url + '/messages/', params={'dst': dst}, json=msg)
+        if self.listener is not None and self.engine == 'process':  # inherited, owned by the receiving process
+            self.listener.close()
+        pipe_ack = unbounded(pipe_ack, objects=True)
+        # one session per server shard, the messages of every shard are posted concurrently
+        sessions: Dict[str, requests.Session] = {}
+        try:
+            # one registration per invocation until the workers are stopped
+            for registration in iter(pipe_sen.recv, STOP):
+                self.route(registration)
+                shards = set(self.peers_shards.values())
+                for shard in shards - sessions.keys():
+                    sessions[shard] = requests.Session()
+                    if self.transport == 'binary':
+                        sessions[shard].headers.update({'Content-Type': OCTET_STREAM})
+                pool = ThreadPoolExecutor(len(shards)) if len(shards) > 1 else None
+                channel = DirectChannel(self.peers_addresses) if self.direct else None
+                closed = False
+                while not closed:
+                    batch = self.drain(pipe_sen)
+                    if batch[-1] is None:  # wrapper is exiting
+                        batch.pop()
+                        closed = True
+                    if channel is not None:
+                        acked, batch = channel.send(batch)
+                        if acked:
+                            pipe_ack.send((acked, True))
+                    owned: Dict[str, List[Tuple[int, int, bytes]]] = {}
+                    for message in batch:
+                        owned.setdefault(self.peers_shards[message[0]], []).append(message)
+                    if pool is None or len(owned) == 1:
+                        for shard, messages in owned.items():
+                            self.relay(sessions[shard], messages, pipe_ack)
+                    else:
+                        for future in [pool.submit(self.relay, sessions[shard], messages, pipe_ack)
+                                       for shard, messages in owned.items()]:
+                            future.result()
+                if channel is not None:
+                    channel.close()
+                if pool is not None:
+                    pool.shutdown()
+                pipe_ack.send(None)  # done with the invocation
+        finally:
+            for session in sessions.values():
+                session.close()
+        logger.info('send() exit!')
+
+    def relay(self, session: requests.Session, messages: List[Tuple[int, int, bytes]],
+              pipe_ack: multiprocessing.connection.Connection):
+        """
+        post messages owned by one server shard, in one request per batch or one per message, and report whether the
+        server accepted them on pipe_ack
+        """
+        chunks = [messages] if self.batch_size > 1 else [[message] for message in messages]
+        for chunk in chunks:
+            pipe_ack.send(([(dst, seq) for dst, seq, _ in chunk], self.post(session, chunk)))
+
+    def post(self, session: requests.Session, batch: List[Tuple[int, int, bytes]]) -> bool:
+        """
+        relay messages through the server shard owning their mailboxes, failed requests are retried
+        :return: whether the server accepted the messages
+        """
+        if self.batch_size > 1:
+            kwargs = {'data': pack_batch(
+                (self.peers_original_peers_mapping[dst_uid], payload) for dst_uid, _, payload in batch)}
+        else:
+            (dst_uid, _, payload), = batch
+            kwargs = {'params': {'dst': self.peers_original_peers_mapping[dst_uid]}}
+            if self.transport == 'binary':
+                kwargs['data'] = payload
+            else:
+                kwargs['json'] = {'payload': base64.b64encode(payload).decode('utf8')}
+        logger.debug('post(): send %d messages', len(batch))
+        backpressure_deadline = time.monotonic() + BACKPRESSURE_TIMEOUT
+        attempt = 0
+        while attempt <= RETRIES:
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+            try:
+                response = session.post(self.peers_shards[batch[0][0]] + '/messages/', **kwargs)
+            except requests.RequestException as e:
+                logger.warning(f'post(): attempt {attempt + 1} failed, {e}')
+                attempt += 1
+                continue
+            if response.ok:
+                return True
+            if response.status_code == 429 and time.monotonic() < backpressure_deadline:
+                logger.debug('post(): mailbox full, retry later')
+                time.sleep(float(response.headers.get('Retry-After', 1)))
+                continue
+            logger.warning(f'post(): attempt {attempt + 1} failed, status code {response.status_code}')
+            if response.status_code < 500:  # retrying does not help
+                break
+            attempt += 1
+        logger.error(f'post(): give up {len(batch)} messages')
+        return False
+
+    def websocket(self, pipe_sen: multiprocessing.connection.Connection,
+                  pipe_rec: multiprocessing.connection.Connection, pipe_ack: multiprocessing.connection.Connection):
+        """
+        send and receive over a single websocket, pushed messages and acknowledgements are read by a background thread
+        """
+        import websocket  # websocket-client, only required by the websocket transport
+
+        logger.info('websocket() start!')
+        pipe_rec = unbounded(pipe_rec)
+        pipe_ack = unbounded(pipe_ack, objects=True)
+        pipe_lock = threading.Lock()
+        if self.direct:
+            threading.Thread(target=self.serve_direct, args=(pipe_rec, pipe_lock), daemon=True).start()
+
+        # one registration per invocation until the workers are stopped, the websocket belongs to the puid
+        for registration in iter(pipe_sen.recv, STOP):
+            self.route(registration)
+            shard = self.peers_shards[self.uid]
+            ws = websocket.create_connection(shard.replace('http', 'ws', 1) + f'/ws/{self.puid}')
+
+            ack_lock = threading.Lock()
+            # (dst uid, sequence number) of the batches sent but not acknowledged by the server yet, oldest first
+            in_flight = collections.deque()
+
+            def receive():
+                try:
+                    while True:
+                        payload = ws.recv()
+                        if not payload:  # close frame
+                            break
+                        if isinstance(payload, str):  # text frames acknowledge the oldest batch in flight
+                            with ack_lock:
+                                pipe_ack.send((in_flight.popleft(), True))
+                            continue
+                        with pipe_lock:
+                            pipe_rec.send_bytes(payload)
+                except (websocket.WebSocketConnectionClosedException, OSError):
+                    pass
+
+            receiver = threading.Thread(target=receive, daemon=True)
+            receiver.start()
+
+            channel = DirectChannel(self.peers_addresses) if self.direct else None
+            closed = False
+            while not closed:
+                batch = self.drain(pipe_sen)
+                if batch[-1] is None:  # wrapper is exiting
+                    batch.pop()
+                    closed = True
+                if channel is not None:
+                    acked, batch = channel.send(batch)
+                    if acked:
+                        with ack_lock:
+                            pipe_ack.send((acked, True))
+                if batch:
+                    logger.debug('websocket(): send batch of %d messages', len(batch))
+                    in_flight.append([(dst, seq) for dst, seq, _ in batch])
+                    ws.send_binary(pack_batch(
+                        (self.peers_original_peers_mapping[dst_uid], payload) for dst_uid, _, payload in batch))
+            if channel is not None:
+                channel.close()
+            ws.close()
+            receiver.join(SHUTDOWN_TIMEOUT)
+            # done with the invocation
+            with pipe_lock:
+                pipe_rec.send_bytes(b'')
+            with ack_lock:
+                pipe_ack.send(None)
+        logger.info('websocket() exit!')
+
+    def serve_direct(self, pipe_rec: multiprocessing.connection.Connection, pipe_lock: threading.Lock):
+        """
+        accept direct connections of other peers and forward their frames to pipe_rec
+        """
+
+        def handle(conn: socket.socket):
+            with conn, conn.makefile('rb') as stream:
+                try:
+                    while True:
+                        payload = read_frame(stream)
+                        if payload is None:
+                            break
+                        # acknowledged as soon as it is read, the sender waits for it
+                        conn.sendall(ACK_HEADER.pack(MESSAGE_HEADER.unpack_from(payload)[1]))
+                        with pipe_lock:
+                            pipe_rec.send_bytes(payload)
+                except OSError:  # the sender gave up on this connection
+                    pass
+
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except OSError:  # listener closed when the workers are stopped
+                break
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    def drain(self, pipe_sen: multiprocessing.connection.Connection) -> List[Optional[Tuple[int, int, bytes]]]:
+        """
+        block until one message is queued, then collect whatever else arrives within linger, up to batch_size messages.
+        The None sentinel sent by wrapper on exit ends the batch.
+        """
+        batch = [pipe_sen.recv()]
+        deadline = time.monotonic() + self.linger
+        while batch[-1] is not None and len(batch) < self.batch_size and \
+                pipe_sen.poll(max(0.0, deadline - time.monotonic())):
+            batch.append(pipe_sen.recv())
+        return batch